@@ -1,44 +1,266 @@
 import threading
 import asyncio
+import abc
 import six
 import time
+import copy
 import copyreg
 import json
 import sys
 import logging
+import logging.handlers
+import atexit
 import uuid
-import websockets
 import string
 import random
 import os
-from markdown import markdown
-import websocket
+import queue
+import base64
+import re
+import heapq
+import hashlib
+import hmac
+import mimetypes
+import importlib
+import functools
+import zlib
+import sqlite3
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from errbot.core import ErrBot
 from errbot.backends.base import Message, Person, Room, RoomOccupant, OFFLINE, RoomDoesNotExistError, Stream
 from errbot import rendering
 from threading import Thread
 
+import requests
 import webexteamssdk
 
 __version__ = "1.6.0"
 
 log = logging.getLogger('errbot.backends.CiscoWebexTeams')
-logging.basicConfig(filename="botbackendlog") 
+
+# Categories that can be given their own level and sample rate in configure_logging
+frames_log = log.getChild('frames')
+messages_log = log.getChild('messages')
+commands_log = log.getChild('commands')
+connection_log = log.getChild('connection')
+
+
+class _LazyModule():
+    """
+    Stands in for a module that is only imported the first time one of its attributes is used
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+# Only needed once a bot actually connects or renders, keep them out of the import time
+websocket = _LazyModule('websocket')
+websockets = _LazyModule('websockets')
+markdown = _LazyModule('markdown')
+
+
+def activity_room_key(activity):
+    """
+    The conversation an activity belongs to, used to keep the activities of a room in order
+    """
+    return activity.get('target', {}).get('id', activity['id'])
+
+
+def handshake_status(error):
+    """
+    HTTP status of a websocket handshake the server refused, None for any other error. websockets raises
+    InvalidStatusCode (status_code) from its legacy client and InvalidStatus (response.status_code) from the client
+    used by default since version 14
+    """
+    legacy = getattr(websockets.exceptions, 'InvalidStatusCode', None)
+    if legacy is not None and isinstance(error, legacy):
+        return error.status_code
+    current = getattr(websockets.exceptions, 'InvalidStatus', None)
+    if current is not None and isinstance(error, current):
+        return error.response.status_code
+    return None
+
+
+def backoff_delay(attempt, base=1, maximum=60):
+    """
+    Seconds to wait before retry number attempt (0 based): exponential with full jitter
+    """
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line. Fields passed as extra={'fields': {...}} become keys of the object.
+    """
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'message': record.getMessage()}
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a fraction of the records below WARNING of some categories
+
+    :param rates: Fraction of the records kept, by category (frames, messages, ...) or full logger name
+    """
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = {}
+        for name, rate in rates.items():
+            self.rates[name if '.' in name else f'{log.name}.{name}'] = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(record.name)
+        return rate is None or random.random() < rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that drops records, counting them, rather than blocking or failing when its queue is full
+    """
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        Only merge the arguments into the message. QueueHandler.prepare also formats the record and drops exc_info,
+        which leaves the listener's formatter no exception to put in its own field
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_log_handler = None
+_log_listener = None
+
+
+def configure_logging(filename="botbackendlog", level=logging.INFO, levels=None, sample=None, structured=True,
+                      console=False, max_queue=10000, trace=False):
+    """
+    Send log records to a file through a queue, so logging never blocks the websocket or handler threads on I/O.
+    Called when a bot starts rather than when the module is imported; only the first call has an effect.
+
+    :param filename: File the records are written to, None to only log to the console
+    :param level: Level of the bot's loggers
+    :param levels: Level by category, e.g. {'frames': logging.DEBUG}. Categories are frames, messages, commands
+                   and connection
+    :param sample: Fraction of the records below WARNING kept by category, e.g. {'frames': 0.01}
+    :param structured: Write JSON lines instead of plain text
+    :param console: Also write the records to stderr
+    :param max_queue: Records waiting to be written beyond this are dropped
+    :param trace: Trace every websocket frame through websocket-client, for debugging only
+    """
+    global _log_handler, _log_listener
+    if _log_handler is not None:
+        return _log_handler
+
+    formatter = StructuredFormatter() if structured else logging.Formatter(logging.BASIC_FORMAT)
+    handlers = []
+    if filename is not None:
+        handlers.append(logging.FileHandler(filename))
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    _log_handler = DroppingQueueHandler(queue.Queue(maxsize=max_queue))
+    if sample:
+        _log_handler.addFilter(SamplingFilter(sample))
+    _log_listener = logging.handlers.QueueListener(_log_handler.queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+    logging.getLogger().addHandler(_log_handler)
+
+    log.setLevel(level)
+    for category, category_level in (levels or {}).items():
+        log.getChild(category).setLevel(category_level)
+    if trace:
+        websocket.enableTrace(True)
+    return _log_handler
+
+
+def logging_stats():
+    """
+    Number of log records dropped because the log queue was full
+    """
+    return {'dropped': _log_handler.dropped if _log_handler is not None else 0}
 
 CISCO_WEBEX_TEAMS_MESSAGE_SIZE_LIMIT = 7439
 
+CISCO_WEBEX_TEAMS_FILE_SIZE_LIMIT = 100 * 1024 * 1024
+
 DEVICES_URL = 'https://wdm-a.wbx2.com/wdm/api/v1/devices'
 
+WEBEX_TEAMS_API_URL = 'https://webexapis.com/v1/'
+
+# Registered devices are remembered here, one file per bot token, so restarts reuse them
+DEVICE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.pywebexbot')
+
 DEVICE_DATA = {
     "deviceName"    : "pywebsocket-client",
     "deviceType"    : "DESKTOP",
     "localizedModel": "python",
     "model"         : "python",
-    "name"          : f"python-webex-teams-client-{''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(5))}",
+    "name"          : "python-webex-teams-client",
     "systemName"    : "python-webex-teams-client",
     "systemVersion" : "0.1"
 }
 
+# Devices were once named with a random suffix, a new one on every start; those left behind are deleted
+LEGACY_DEVICE_NAME = re.compile(r'python-webex-teams-client-[A-Z0-9]{5}')
+
+# (connect, read) timeouts in seconds of REST calls, by endpoint; None applies to the endpoints not listed and
+# upload to file uploads
+REST_TIMEOUTS = {
+    None: (3.05, 30),
+    'messages': (3.05, 20),
+    'attachment/actions': (3.05, 10),
+    'people': (3.05, 10),
+    'rooms': (3.05, 10),
+    'memberships': (3.05, 20),
+    'upload': (3.05, 300),
+}
+
+# Activity verbs that change a room or who is in it
+ROOM_EVENT_VERBS = ('add', 'leave', 'update', 'lock', 'unlock', 'assignModerator', 'unassignModerator', 'delete')
+
+# people.list() accepts at most this many comma separated IDs
+PEOPLE_LIST_MAX_IDS = 85
+
+ADAPTIVE_CARD_CONTENT_TYPE = 'application/vnd.microsoft.card.adaptive'
+
+# What the dispatcher does with a new job once its queue is full
+DISPATCH_BLOCK = 'block'
+DISPATCH_DROP = 'drop'
+DISPATCH_REJECT = 'reject'
+
+# Child processes are spawned, never forked: by the time they start, the bot runs dispatcher, outbox, upload, room
+# index and logging threads whose locks a forked child could inherit while they are held
+_process_context = multiprocessing.get_context('spawn')
+
 
 class FailedToCreateWebexDevice(Exception):
     pass
@@ -52,6 +274,619 @@ class FailedToFindWebexTeamsRoom(Exception):
     pass
 
 
+class FileTooLarge(Exception):
+    pass
+
+
+class AsyncApiError(Exception):
+    """
+    A Webex Teams REST call made through AsyncWebexTeamsAPI failed
+    """
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(f'{status}: {message}')
+        self.status = status
+        self.retry_after = retry_after
+
+
+def webex_uuid(webex_id):
+    """
+    Return the UUID at the end of a Webex Teams REST ID (base64 of ciscospark://us/ROOM/<uuid>).
+
+    Websocket activities only carry the bare UUID, so caches are keyed on it to match both forms.
+    """
+    if webex_id is None or '-' in webex_id:
+        return webex_id
+    try:
+        decoded = base64.b64decode(webex_id + '=' * (-len(webex_id) % 4)).decode('utf-8')
+    except (ValueError, UnicodeDecodeError):
+        return webex_id
+    return decoded.rsplit('/', 1)[-1]
+
+
+# Upper bounds, in seconds, of the buckets of the stage latency histograms
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def rest_endpoint(url):
+    """
+    The endpoint a REST URL calls, with the object IDs left out, e.g. messages or attachment/actions
+    """
+    path = url.split('?', 1)[0]
+    if path.startswith(WEBEX_TEAMS_API_URL):
+        path = path[len(WEBEX_TEAMS_API_URL):]
+    elif '://' in path:
+        path = path.split('://', 1)[1].partition('/')[2]
+    segments = []
+    for segment in path.strip('/').split('/'):
+        if len(segment) >= 32:
+            break
+        segments.append(segment)
+    return '/'.join(segments)
+
+
+class _Stage():
+    """
+    Times one stage for Metrics.stage, telling the hooks when it starts and finishes
+    """
+    __slots__ = ('_metrics', '_name', '_labels', '_started')
+
+    def __init__(self, metrics, name, labels):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._metrics._call_hooks('stage_started', self._name, self._labels)
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._started
+        self._metrics.observe(self._name, seconds, exc, **self._labels)
+        return False
+
+
+class Metrics():
+    """
+    Counters, gauges and per stage latency histograms, rendered in the Prometheus text format.
+
+    Stages are timed with `with metrics.stage('hydrate'):` or recorded with observe. Hooks are objects attached with
+    add_hook, e.g. a profiler or a tracer; each method they define is called:
+        stage_started(stage, labels)
+        stage_finished(stage, seconds, labels, error)
+        counted(name, value, labels)
+    Exceptions raised by hooks are logged and otherwise ignored.
+    """
+    def __init__(self, prefix='firebot', buckets=METRICS_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.hooks = []
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._server = None
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def _call_hooks(self, method, *args):
+        for hook in self.hooks:
+            func = getattr(hook, method, None)
+            if func is None:
+                continue
+            try:
+                func(*args)
+            except Exception:
+                log.exception(f'Metrics hook {hook!r} failed in {method}')
+
+    def gauge(self, name, func, **labels):
+        """
+        Report the value returned by func, read whenever the metrics are rendered
+        """
+        with self._lock:
+            self._gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = func
+
+    def inc(self, name, value=1, **labels):
+        """
+        Add value to the counter name, whose rendered name gets a _total suffix
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+        self._call_hooks('counted', name, value, labels)
+
+    def stage(self, name, **labels):
+        return _Stage(self, name, labels)
+
+    def observe(self, stage, seconds, error=None, **labels):
+        """
+        Record that stage took seconds
+        """
+        key = tuple(sorted(dict(labels, stage=stage).items()))
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += seconds
+            entry[2] += 1
+        self._call_hooks('stage_finished', stage, seconds, labels, error)
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+    def snapshot(self):
+        """
+        The stage latencies (count, sum and average) and counters as plain dicts
+        """
+        with self._lock:
+            stages = {}
+            for key, (_, total, count) in self._histograms.items():
+                labels = dict(key)
+                name = labels.pop('stage')
+                if labels:
+                    name += '{' + ','.join(f'{k}={v}' for k, v in sorted(labels.items())) + '}'
+                stages[name] = {'count': count, 'sum': total, 'avg': total / count if count else 0.0}
+            counters = {name: sum(series.values()) for name, series in self._counters.items()}
+        return {'stages': stages, 'counters': counters}
+
+    @staticmethod
+    def _labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {key: (list(b), total, count) for key, (b, total, count) in self._histograms.items()}
+            gauges = {name: dict(series) for name, series in self._gauges.items()}
+
+        for name, series in sorted(counters.items()):
+            metric = f'{self.prefix}_{name}_total'
+            lines.append(f'# TYPE {metric} counter')
+            for key, value in series.items():
+                lines.append(f'{metric}{self._labels(key)} {value}')
+
+        for name, series in sorted(gauges.items()):
+            metric = f'{self.prefix}_{name}'
+            lines.append(f'# TYPE {metric} gauge')
+            for key, func in series.items():
+                try:
+                    value = func()
+                except Exception:
+                    log.exception(f'Failed to read gauge {name}')
+                    continue
+                lines.append(f'{metric}{self._labels(key)} {value}')
+
+        if histograms:
+            metric = f'{self.prefix}_stage_seconds'
+            lines.append(f'# TYPE {metric} histogram')
+            for key, (buckets, total, count) in sorted(histograms.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, buckets):
+                    cumulative += n
+                    lines.append(f'{metric}_bucket{self._labels(key, (("le", bound),))} {cumulative}')
+                lines.append(f'{metric}_bucket{self._labels(key, (("le", "+Inf"),))} {count}')
+                lines.append(f'{metric}_sum{self._labels(key)} {total}')
+                lines.append(f'{metric}_count{self._labels(key)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=9464, host='127.0.0.1'):
+        """
+        Serve render() at http://host:port/metrics from a background thread
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, name="firebot-metrics", daemon=True).start()
+        log.info(f'Serving metrics on http://{host}:{port}/metrics')
+        return self._server
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+
+class TTLCache():
+    """
+    A thread safe, size bounded mapping whose entries expire after ttl seconds.
+    When full, the least recently used entry is evicted.
+    """
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RoomIndex():
+    """
+    Title and ID index of the rooms the bot is a member of.
+
+    The index is built from one rooms.list() on first use. After that it is kept current by refreshing the single
+    rooms that websocket activities report as changed, and is fully reconciled every reconcile_interval seconds.
+    Refreshes and reconciliation both run on a background thread. Refresh requests are handed over through a queue
+    and the rooms are listed without holding the index lock, so neither delays the websocket reader.
+    """
+    def __init__(self, backend, reconcile_interval=900):
+        self._backend = backend
+        self.reconcile_interval = reconcile_interval
+        self._by_id = {}
+        self._by_title = {}
+        self._lock = threading.Lock()
+        # Serializes the rooms.list() calls, readers and writers of the index only ever take _lock
+        self._build_lock = threading.Lock()
+        self._built = False
+        self._pending = queue.Queue()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def _ensure_built(self):
+        if not self._built:
+            with self._build_lock:
+                if not self._built:
+                    self._rebuild()
+            self._start()
+
+    def rebuild(self):
+        """
+        Reload the whole index from rooms.list()
+        """
+        with self._build_lock:
+            self._rebuild()
+        self._start()
+
+    def _rebuild(self):
+        by_id = {}
+        by_title = {}
+        for room in self._backend.webex_teams_api.rooms.list():
+            by_id[webex_uuid(room.id)] = room
+            # TODO: not sure room title will duplicate, keep the first one like rooms.list() did
+            by_title.setdefault(room.title, webex_uuid(room.id))
+        with self._lock:
+            self._by_id = by_id
+            self._by_title = by_title
+            self._built = True
+        log.debug(f'Room index built with {len(by_id)} rooms')
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="firebot-room-index", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        next_reconcile = time.monotonic() + self.reconcile_interval
+        while True:
+            self._wakeup.wait(max(0, next_reconcile - time.monotonic()))
+            self._wakeup.clear()
+            try:
+                if time.monotonic() >= next_reconcile:
+                    self.rebuild()
+                    next_reconcile = time.monotonic() + self.reconcile_interval
+                else:
+                    pending = set()
+                    while True:
+                        try:
+                            pending.add(self._pending.get_nowait())
+                        except queue.Empty:
+                            break
+                    for room_id in pending:
+                        self._refresh(room_id)
+            except Exception:
+                log.exception('Failed to update the room index')
+
+    def _refresh(self, room_id):
+        key = webex_uuid(room_id)
+        self._backend.room_cache.invalidate(key)
+        try:
+            room = self._backend.webex_teams_api.rooms.get(room_id)
+        except webexteamssdk.exceptions.ApiError:
+            self.remove(room_id)
+            return
+        self._backend.room_cache.put(key, room)
+        self.upsert(room)
+
+    def schedule_refresh(self, room_id):
+        """
+        Re-read a single room in the background, dropping it if the bot can no longer see it
+        """
+        if not self._built:
+            return
+        self._pending.put(room_id)
+        self._wakeup.set()
+
+    def upsert(self, room):
+        with self._lock:
+            key = webex_uuid(room.id)
+            old = self._by_id.get(key)
+            if old is not None and self._by_title.get(old.title) == key:
+                del self._by_title[old.title]
+            self._by_id[key] = room
+            self._by_title.setdefault(room.title, key)
+
+    def remove(self, room_id):
+        with self._lock:
+            room = self._by_id.pop(webex_uuid(room_id), None)
+            if room is not None and self._by_title.get(room.title) == webex_uuid(room_id):
+                del self._by_title[room.title]
+
+    def by_id(self, room_id):
+        self._ensure_built()
+        return self._by_id.get(webex_uuid(room_id))
+
+    def by_title(self, title):
+        self._ensure_built()
+        key = self._by_title.get(title)
+        return self._by_id.get(key) if key is not None else None
+
+    def all(self):
+        self._ensure_built()
+        return list(self._by_id.values())
+
+    def __len__(self):
+        return len(self._by_id)
+
+
+class PersonCache():
+    """
+    Bounded TTL cache of webexteamssdk Person objects, reachable by id, email and displayName.
+
+    Lookups that find nobody are cached too, for negative_ttl seconds, so repeated misses do not hit the API.
+    What a bot can see depends on its token, so a cache belongs to a single backend and makes its API calls with it.
+    """
+    NOT_FOUND = object()
+
+    def __init__(self, backend, maxsize=4096, ttl=3600, negative_ttl=300):
+        self._backend = backend
+        self.negative_ttl = negative_ttl
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def add(self, person):
+        """
+        Cache a webexteamssdk Person under its id, each of its emails and its displayName
+        """
+        if person.id:
+            self._cache.put(('id', webex_uuid(person.id)), person)
+        for email in person.emails or []:
+            self._cache.put(('email', email.lower()), person)
+        if person.displayName:
+            self._cache.put(('name', person.displayName), person)
+
+    def add_missing(self, kind, value):
+        self._cache.put((kind, value), self.NOT_FOUND, ttl=self.negative_ttl)
+
+    def _lookup(self, kind, value, fetch):
+        cached = self._cache.get((kind, value))
+        if cached is self.NOT_FOUND:
+            return None
+        if cached is not None:
+            return cached
+
+        person = fetch()
+        if person is None:
+            self.add_missing(kind, value)
+        else:
+            self.add(person)
+            # The person may be known under a different spelling of the key
+            self._cache.put((kind, value), person)
+        return person
+
+    def _first(self, **params):
+        for person in self._backend.webex_teams_api.people.list(**params):
+            return person
+        return None
+
+    def by_email(self, email):
+        """
+        Return the FIRST person found with this email address, or None
+        """
+        return self._lookup('email', email.lower(), lambda: self._first(email=email))
+
+    def by_name(self, name):
+        """
+        Return the FIRST person found with this display name, or None
+        """
+        return self._lookup('name', name, lambda: self._first(displayName=name))
+
+    def by_id(self, person_id):
+        """
+        Return the person with this ID, or None
+        """
+        def fetch():
+            try:
+                return self._backend.webex_teams_api.people.get(person_id)
+            except webexteamssdk.exceptions.ApiError as error:
+                if error.response.status_code == 404:
+                    return None
+                raise
+
+        return self._lookup('id', webex_uuid(person_id), fetch)
+
+    def warm(self, person_ids):
+        """
+        Load many people with as few people.list() calls as possible
+
+        :param person_ids: Webex Teams person IDs, those already cached are skipped
+        :return: Number of people loaded
+        """
+        missing = [pid for pid in dict.fromkeys(person_ids) if self._cache.get(('id', webex_uuid(pid))) is None]
+        loaded = 0
+        for i in range(0, len(missing), PEOPLE_LIST_MAX_IDS):
+            batch = missing[i:i + PEOPLE_LIST_MAX_IDS]
+            found = set()
+            for person in self._backend.webex_teams_api.people.list(id=','.join(batch)):
+                self.add(person)
+                found.add(webex_uuid(person.id))
+                loaded += 1
+            for pid in batch:
+                if webex_uuid(pid) not in found:
+                    self.add_missing('id', webex_uuid(pid))
+        return loaded
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class RoomMember():
+    """
+    Compact record of one room membership
+    """
+    __slots__ = ('id', 'email')
+
+    def __init__(self, person_id, email):
+        self.id = person_id
+        self.email = email
+
+
+class MembershipSnapshot():
+    """
+    The members of one room, indexed by person UUID and by lower cased email.
+
+    Kept current from membership activities so membership checks and counts need no API call.
+    """
+    __slots__ = ('room_id', '_members', '_emails')
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self._members = {}
+        self._emails = {}
+
+    def add(self, person_id, email):
+        key = webex_uuid(person_id)
+        self.remove(key)
+        self._members[key] = RoomMember(person_id, email)
+        if email:
+            self._emails[email.lower()] = key
+
+    def remove(self, person_id):
+        member = self._members.pop(webex_uuid(person_id), None)
+        if member is not None and member.email:
+            self._emails.pop(member.email.lower(), None)
+
+    def __contains__(self, id_or_email):
+        if '@' in id_or_email:
+            return id_or_email.lower() in self._emails
+        return webex_uuid(id_or_email) in self._members
+
+    def __len__(self):
+        return len(self._members)
+
+    def __iter__(self):
+        return iter(list(self._members.values()))
+
+
+class WebexObject():
+    """
+    Lightweight, read only view of a Webex Teams REST object, handed to FireBot command handlers.
+
+    Fields are read straight from the decoded JSON (msg.roomId, msg.text, ...), returning None for fields the object
+    does not carry, like the webexteamssdk models do. The webexteamssdk model itself is only built if a handler asks
+    for it through .sdk.
+    """
+    __slots__ = ('_json', '_model', '_sdk')
+
+    def __init__(self, json_data, model=None):
+        self._json = json_data
+        self._model = model
+        self._sdk = None
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._json.get(name)
+
+    @property
+    def sdk(self):
+        """The equivalent webexteamssdk model, built on first access"""
+        if self._sdk is None:
+            self._sdk = self._model(self._json)
+        return self._sdk
+
+    def json(self):
+        return json.dumps(self._json)
+
+    def to_dict(self):
+        return dict(self._json)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self._json!r})'
+
+
 class CiscoWebexTeamsMessage(Message):
     """
     A Cisco Webex Teams Message
@@ -129,31 +964,34 @@ class CiscoWebexTeamsPerson(Person):
         Return the FIRST Cisco Webex Teams person found when searching using an email address
         """
         try:
-            for person in self._backend.webex_teams_api.people.list(email=self.email):
-                self.teams_person = person
-                return
+            person = self._backend.person_cache.by_email(self.email)
         except:
             raise FailedToFindWebexTeamsPerson(f'Could not find a user using the email address {self.email}')
+        if person is not None:
+            self.teams_person = person
 
     def find_using_name(self):
         """
         Return the FIRST Cisco Webex Teams person found when searching using the display name
         """
         try:
-            for person in self._backend.webex_teams_api.people.list(displayName=self.displayName):
-                self.teams_person = person
-                return
+            person = self._backend.person_cache.by_name(self.displayName)
         except:
             raise FailedToFindWebexTeamsPerson(f'Could not find the user using the displayName {self.displayName}')
+        if person is not None:
+            self.teams_person = person
 
     def get_using_id(self):
         """
         Return a Cisco Webex Teams person when searching using an ID
         """
         try:
-            self._backend.webex_teams_api.people.get(self.id)
+            person = self._backend.person_cache.by_id(self.id)
         except:
-          raise FailedToFindWebexTeamsPerson(f'Could not find the user using the id {self.id}')
+            person = None
+        if person is None:
+            raise FailedToFindWebexTeamsPerson(f'Could not find the user using the id {self.id}')
+        self.teams_person = person
 
     # Required by the Err API
 
@@ -235,15 +1073,13 @@ class CiscoWebexTeamsRoom(Room):
         """
         Load a room object from a title. If no room is found, return a new Room object.
         """
-        rooms = self._backend.webex_teams_api.rooms.list()
-        room = [room for room in rooms if room.title == self._room_title]
+        room = self._backend.room_index.by_title(self._room_title)
 
-        if not len(room) > 0:
+        if room is None:
             self._room = webexteamssdk.models.immutable.Room({})
             self._room_id = None
         else:
-            # TODO: not sure room title will duplicate
-            self._room = room[0]
+            self._room = room
             self._room_id = self._room.id
 
     def load_room_from_id(self):
@@ -251,7 +1087,7 @@ class CiscoWebexTeamsRoom(Room):
         Load a room object from a webex room id. If no room is found, return a new Room object.
         """
         try:
-            self._room = self._backend.webex_teams_api.rooms.get(self._room_id)
+            self._room = self._backend.fetch_room(self._room_id)
             self._room_title = self._room.title
         except webexteamssdk.exceptions.ApiError:
             self._room = webexteamssdk.models.immutable.Room({})
@@ -306,6 +1142,8 @@ class CiscoWebexTeamsRoom(Room):
         """
         self._room = self._backend.webex_teams_api.rooms.create(self.title)
         self._room_id = self._room.id
+        self._backend.room_cache.put(webex_uuid(self._room_id), self._room)
+        self._backend.room_index.upsert(self._room)
         self._backend.webex_teams_api.messages.create(roomId=self._room_id, text="Welcome to the room!")
         log.debug(f'Created room: {self.title}')
 
@@ -315,6 +1153,8 @@ class CiscoWebexTeamsRoom(Room):
         :return:
         """
         self._backend.webex_teams_api.rooms.delete(self.id)
+        self._backend.room_cache.invalidate(webex_uuid(self.id))
+        self._backend.room_index.remove(self.id)
         # We want to re-init this room so that is accurately reflects that is no longer exists
         self.load_room_from_title()
         log.debug(f'Deleted room: {self.title}')
@@ -325,8 +1165,7 @@ class CiscoWebexTeamsRoom(Room):
 
     @property
     def joined(self):
-        rooms = self._backend.webex_teams_api.rooms.list()
-        return len([room for room in rooms if room.title == room.title]) > 0
+        return self.id is not None and self._backend.room_index.by_id(self.id) is not None
 
     @property
     def topic(self):
@@ -339,21 +1178,49 @@ class CiscoWebexTeamsRoom(Room):
 
     @property
     def occupants(self):
+        occupants = list(self.iter_occupants())
+
+        log.debug("Total occupants for room {} ({}) is {} ".format(self.title, self.id, len(occupants)))
+
+        return occupants
+
+    def iter_occupants(self):
+        """
+        Yield the occupants of the room one at a time.
 
+        Served from the room's membership snapshot when one is cached, otherwise memberships are streamed from the
+        API and the snapshot is stored once the listing has been read to the end.
+        """
         if not self.exists:
             raise RoomDoesNotExistError(f"Room {self.title or self.id} does not exist, or the bot does not have access")
 
-        occupants = []
+        snapshot = self._backend.membership_cache.get(webex_uuid(self.id))
+        if snapshot is not None:
+            for member in snapshot:
+                yield self._occupant(member.id, member.email)
+            return
 
-        for person in self._backend.webex_teams_api.memberships.list(roomId=self.id):
-            p = CiscoWebexTeamsPerson(backend=self._backend)
-            p.id = person.personId
-            p.email = person.personEmail
-            occupants.append(CiscoWebexTeamsRoomOccupant(backend=self._backend, room=self, person=p))
+        snapshot = MembershipSnapshot(self.id)
+        for membership in self._backend.webex_teams_api.memberships.list(roomId=self.id):
+            snapshot.add(membership.personId, membership.personEmail)
+            yield self._occupant(membership.personId, membership.personEmail)
+        self._backend.membership_cache.put(webex_uuid(self.id), snapshot)
 
-        log.debug("Total occupants for room {} ({}) is {} ".format(self.title, self.id, len(occupants)))
+    def _occupant(self, person_id, email):
+        p = CiscoWebexTeamsPerson(backend=self._backend)
+        p.id = person_id
+        p.email = email
+        return CiscoWebexTeamsRoomOccupant(backend=self._backend, room=self, person=p)
 
-        return occupants
+    @property
+    def occupant_count(self):
+        return len(self._backend.membership_snapshot(self.id))
+
+    def has_occupant(self, id_or_email):
+        """
+        Check whether a person, given by Webex Teams ID or email address, is a member of the room
+        """
+        return id_or_email in self._backend.membership_snapshot(self.id)
 
     def invite(self, *args):
         log.debug("Invite room yet to be implemented")  # TODO
@@ -368,94 +1235,859 @@ class CiscoWebexTeamsRoom(Room):
     __str__ = __unicode__
 
 
-class CiscoWebexTeamsBackend(ErrBot):
+class _AsyncEndpoint():
     """
-    This is the CiscoWebexTeams backend for errbot.
+    Base for the resources exposed by AsyncWebexTeamsAPI
     """
+    path = None
+    model = None
 
-    wsk = None
-    def __init__(self, token):
+    def __init__(self, api):
+        self._api = api
 
-        bot_identity = BOT_IDENTITY = {
-            'TOKEN': token,
-        }
-        self.md = rendering.md()
+    async def get(self, item_id):
+        return self.model(await self._api.request('GET', f'{self.path}/{item_id}'))
 
-        # Do we have the basic mandatory config needed to operate the bot
-        self._bot_token = bot_identity.get('TOKEN', None)
-        if not self._bot_token:
-            log.fatal('You need to define the Cisco Webex Teams Bot TOKEN in the BOT_IDENTITY of config.py.')
-            sys.exit(1)
+    async def get_light(self, item_id):
+        """Same as get, returning a WebexObject instead of the webexteamssdk model"""
+        return WebexObject(await self._api.request('GET', f'{self.path}/{item_id}'), self.model)
 
-        print("Setting up SparkAPI")
-        self.webex_teams_api = webexteamssdk.WebexTeamsAPI(access_token=self._bot_token)
+    async def list(self, **params):
+        async for item in self._api.paginate(self.path, params):
+            yield self.model(item)
 
-        print("Setting up device on Webex Teams")
-        self.device_info = self._get_device_info()
 
-        print("Fetching and building identifier for the bot itself.")
-        self.bot_identifier = CiscoWebexTeamsPerson(self, self.webex_teams_api.people.me())
+class _AsyncMessages(_AsyncEndpoint):
+    path = 'messages'
+    model = webexteamssdk.Message
 
-        print("Done! I'm connected as {}".format(self.bot_identifier.email))
+    async def create(self, **payload):
+        return self.model(await self._api.request('POST', self.path, json=payload))
 
-        self._register_identifiers_pickling()
+    async def delete(self, messageId):
+        await self._api.request('DELETE', f'{self.path}/{messageId}')
 
-    @property
-    def mode(self):
-        return 'CiscoWebexTeams'
 
-    def is_from_self(self, message):
-      return message.frm.id == message.to.id
+class _AsyncAttachmentActions(_AsyncEndpoint):
+    path = 'attachment/actions'
+    model = webexteamssdk.AttachmentAction
 
-    def process_websocket(self, message):
-        """
-        Process the data from the websocket and determine if we need to ack on it
-        :param message: The message received from the websocket
-        :return:
-        """
-        message = json.loads(message.decode('utf-8'))
-        if message['data']['eventType'] != 'conversation.activity':
-            logging.debug('Ignoring message where Event Type is not conversation.activity')
-            return
 
-        activity = message['data']['activity']
+class _AsyncPeople(_AsyncEndpoint):
+    path = 'people'
+    model = webexteamssdk.Person
 
-        if activity['verb'] != 'post':
-            logging.debug('Ignoring message where the verb is not type "post"')
-            return
+    async def me(self):
+        return await self.get('me')
 
-        spark_message = self.webex_teams_api.messages.get(activity['id'])
 
-        if spark_message.personEmail in self.bot_identifier.emails:
-            logging.debug('Ignoring message from myself')
-            return
+class _AsyncRooms(_AsyncEndpoint):
+    path = 'rooms'
+    model = webexteamssdk.Room
 
-        logging.info('Message from %s: %s\n' % (spark_message.personEmail, spark_message.text))
-        self.callback_message(self.get_message(spark_message))
+    async def create(self, title, teamId=None):
+        payload = {'title': title}
+        if teamId is not None:
+            payload['teamId'] = teamId
+        return self.model(await self._api.request('POST', self.path, json=payload))
 
-    def get_message(self, message):
-        """
-        Create an errbot message object
-        """
-        person = CiscoWebexTeamsPerson(self)
-        person.id = message.id
-        person.email = message.personEmail
-        try:
-            parentId = message.parentId
-        except AttributeError:
-            parentId = message.id
+    async def delete(self, roomId):
+        await self._api.request('DELETE', f'{self.path}/{roomId}')
 
-        room = CiscoWebexTeamsRoom(backend=self, room_id=message.roomId)
-        occupant = CiscoWebexTeamsRoomOccupant(self, person=person, room=room)
-        msg = CiscoWebexTeamsMessage(body=message.markdown or message.text,
-                                     frm=occupant,
-                                     to=room,
-                                     extras={'roomType': message.roomType,'parentId': parentId})
-        return msg
 
-    def follow_room(self, room):
+class AsyncWebexTeamsAPI():
+    """
+    asyncio counterpart of the parts of webexteamssdk.WebexTeamsAPI used by the bot, built on aiohttp.
+
+    Results are returned as the same webexteamssdk models the synchronous API returns.
+    """
+    def __init__(self, access_token, base_url=WEBEX_TEAMS_API_URL, wait_on_rate_limit=True, session=None,
+                 metrics=None):
+        self.base_url = base_url
+        self.metrics = metrics
+        self.wait_on_rate_limit = wait_on_rate_limit
+        self._headers = {'Authorization': 'Bearer ' + access_token,
+                         'Content-type': 'application/json;charset=utf-8'}
+        self._session = session
+        self._owns_session = session is None
+
+        self.messages = _AsyncMessages(self)
+        self.attachment_actions = _AsyncAttachmentActions(self)
+        self.people = _AsyncPeople(self)
+        self.rooms = _AsyncRooms(self)
+
+    def _get_session(self):
+        if self._session is None:
+            import aiohttp
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def _send(self, method, url, params=None, json=None):
         """
-        Backend: Follow Room yet to be implemented
+        Perform a request, waiting out rate limiting, and return the decoded body with the next page URL if any
+        """
+        session = self._get_session()
+        if not url.startswith('http'):
+            url = self.base_url + url
+
+        if self.metrics is not None:
+            self.metrics.inc('rest_requests', method=method, endpoint=rest_endpoint(url))
+        while True:
+            async with session.request(method, url, params=params, json=json, headers=self._headers) as resp:
+                retry_after = resp.headers.get('Retry-After')
+                if resp.status == 429 and self.wait_on_rate_limit:
+                    await asyncio.sleep(int(retry_after or 15))
+                    continue
+                if resp.status >= 400:
+                    raise AsyncApiError(resp.status, await resp.text(), retry_after)
+
+                next_page = resp.links.get('next')
+                next_url = str(next_page['url']) if next_page else None
+                if resp.status == 204:
+                    return None, next_url
+                return await resp.json(), next_url
+
+    async def request(self, method, url, params=None, json=None):
+        data, _ = await self._send(method, url, params=params, json=json)
+        return data
+
+    async def paginate(self, url, params=None):
+        while url:
+            data, url = await self._send('GET', url, params=params)
+            params = None
+            for item in data.get('items', []):
+                yield item
+
+    async def close(self):
+        if self._session is not None and self._owns_session:
+            await self._session.close()
+        self._session = None
+
+
+class Renderer():
+    """
+    Converts message bodies to the markdown sent to Webex Teams and parses JSON card attachments, caching both by
+    a hash of their content.
+
+    md is an errbot markdown converter applied first, or a callable creating it on first use.
+    """
+    def __init__(self, md=None, maxsize=1024):
+        self._md = md
+        self._webex_md = None
+        self._lock = threading.Lock()
+        self._markdown = TTLCache(maxsize=maxsize, ttl=float('inf'))
+        self._json = TTLCache(maxsize=maxsize, ttl=float('inf'))
+
+    @property
+    def md(self):
+        if callable(self._md):
+            self._md = self._md()
+        return self._md
+
+    @staticmethod
+    def _key(text):
+        return hashlib.sha1(text.encode('utf-8')).digest()
+
+    def markdown(self, body):
+        key = self._key(body)
+        md = self._markdown.get(key)
+        if md is None:
+            with self._lock:
+                if self._webex_md is None:
+                    # "markdown extra" is not supported by Webex Teams, this instance is reused for every conversion
+                    self._webex_md = markdown.Markdown(extensions=['markdown.extensions.nl2br',
+                                                                   'markdown.extensions.fenced_code'])
+                if self.md is not None:
+                    body = self.md.convert(body)
+                md = self._webex_md.reset().convert(body)
+            self._markdown.put(key, md)
+        return md
+
+    def card(self, text):
+        """
+        Parse a JSON attachment. The returned dict is shared between callers and must not be modified
+        """
+        key = self._key(text)
+        card = self._json.get(key)
+        if card is None:
+            card = json.loads(text)
+            self._json.put(key, card)
+        return card
+
+    def stats(self):
+        return {'markdown': self._markdown.stats(), 'json': self._json.stats()}
+
+
+class CardTemplates():
+    """
+    Registry of adaptive cards loaded and validated once, then rendered with ${placeholder} substitution.
+
+    Rendered cards are cached per template and values, so sending the same card again costs a dict lookup.
+    """
+    def __init__(self, maxsize=256):
+        self._templates = {}
+        self._rendered = TTLCache(maxsize=maxsize, ttl=float('inf'))
+
+    def register(self, name, source):
+        """
+        Add a card template
+
+        :param name: Name used to render the card
+        :param source: Path of a JSON file, a JSON string or a dict. Either the card itself or a complete attachment
+                       with contentType and content
+        """
+        if isinstance(source, dict):
+            card = source
+        elif isinstance(source, str) and source.lstrip().startswith('{'):
+            card = json.loads(source)
+        else:
+            with open(source) as f:
+                card = json.load(f)
+
+        if 'contentType' not in card:
+            card = {'contentType': ADAPTIVE_CARD_CONTENT_TYPE, 'content': card}
+        if card['contentType'] != ADAPTIVE_CARD_CONTENT_TYPE or card['content'].get('type') != 'AdaptiveCard':
+            raise ValueError(f"Card template {name} is not an adaptive card")
+
+        self._templates[name] = string.Template(json.dumps(card))
+        self._rendered.clear()
+
+    def render(self, name, /, **values):
+        """
+        Return the attachment for a template, ${key} placeholders in it replaced by values; name is positional so
+        ${name} can be filled in too.
+        The returned dict is shared between callers and must not be modified
+        """
+        key = (name, tuple(sorted((k, str(v)) for k, v in values.items())))
+        card = self._rendered.get(key)
+        if card is None:
+            escaped = {k: json.dumps(str(v))[1:-1] for k, v in values.items()}
+            card = json.loads(self._templates[name].safe_substitute(escaped))
+            self._rendered.put(key, card)
+        return card
+
+    def __contains__(self, name):
+        return name in self._templates
+
+
+class MultipartStream():
+    """
+    multipart/form-data body for messages.create with one file, produced chunk by chunk so the file is never held in
+    memory.
+
+    source is a path, a file object or an iterable of bytes. The body length is known, and sent as Content-Length,
+    when size is given or can be found from the path or file; otherwise the body is sent with chunked encoding.
+    Bodies built from a path or a seekable file are replayable: they can be iterated again, e.g. when the request is
+    retried. One built from an iterable or a pipe can only be sent once.
+    """
+    def __init__(self, fields, source, filename=None, content_type=None, size=None, progress=None,
+                 chunk_size=64 * 1024, limit=CISCO_WEBEX_TEAMS_FILE_SIZE_LIMIT):
+        self.fields = fields
+        self.source = source
+        self.filename = filename or os.path.basename(getattr(source, 'name', None) or
+                                                     (source if isinstance(source, str) else 'file'))
+        self.file_type = content_type or mimetypes.guess_type(self.filename)[0] or 'application/octet-stream'
+        self.progress = progress
+        self.chunk_size = chunk_size
+        self.limit = limit
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+
+        if size is None:
+            if isinstance(source, str):
+                size = os.path.getsize(source)
+            elif hasattr(source, 'seekable') and source.seekable():
+                start = source.tell()
+                size = source.seek(0, os.SEEK_END) - start
+                source.seek(start)
+        self.size = size
+        if size is not None and size > limit:
+            raise FileTooLarge(f'{self.filename} is {size} bytes, Webex Teams accepts at most {limit}')
+
+        self._head = b''.join(self._field(name, value) for name, value in fields.items() if value is not None)
+        self._head += (f'--{self.boundary}\r\nContent-Disposition: form-data; name="files"; '
+                       f'filename="{self.filename}"\r\nContent-Type: {self.file_type}\r\n\r\n').encode('utf-8')
+        self._tail = f'\r\n--{self.boundary}--\r\n'.encode('utf-8')
+        seekable = hasattr(source, 'seekable') and source.seekable()
+        self._start = source.tell() if seekable else None
+        self.replayable = isinstance(source, str) or seekable
+
+    def _field(self, name, value):
+        return (f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+                ).encode('utf-8')
+
+    def __len__(self):
+        # requests sends Content-Length for a non zero length and falls back to chunked encoding otherwise
+        if self.size is None:
+            return 0
+        return len(self._head) + self.size + len(self._tail)
+
+    def _chunks(self):
+        if isinstance(self.source, str):
+            with open(self.source, 'rb') as f:
+                yield from iter(lambda: f.read(self.chunk_size), b'')
+        elif hasattr(self.source, 'read'):
+            if self._start is not None:
+                self.source.seek(self._start)
+            yield from iter(lambda: self.source.read(self.chunk_size), b'')
+        else:
+            yield from self.source
+
+    def __iter__(self):
+        yield self._head
+        sent = 0
+        for chunk in self._chunks():
+            sent += len(chunk)
+            if sent > self.limit:
+                raise FileTooLarge(f'{self.filename} exceeds the Webex Teams limit of {self.limit} bytes')
+            yield chunk
+            if self.progress is not None:
+                self.progress(sent, self.size)
+        yield self._tail
+
+
+class UploadPool():
+    """
+    Runs file uploads on a few dedicated threads, so large attachments neither block command handlers nor take the
+    outbox workers. At most max_pending uploads are queued; submit blocks beyond that.
+
+    A rate limited upload is retried after the Retry-After period, up to max_retries times, when its body can be
+    read again. Any other upload fails with the RateLimitError.
+    """
+    def __init__(self, backend, workers=2, max_pending=16, max_retries=5):
+        self._backend = backend
+        self.max_retries = max_retries
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="firebot-upload")
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, func, *args):
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def upload(self, fields, source, filename=None, content_type=None, size=None, progress=None):
+        """
+        Queue a messages.create with one file attached
+
+        :param fields: The other messages.create fields, e.g. roomId and text
+        :param source: A path, a file object or an iterable of bytes
+        :param progress: Called with (bytes sent, total size or None) as the upload progresses
+        :return: A Future resolved with the created webexteamssdk Message
+        :raises FileTooLarge: right away when the size is known to exceed the Webex Teams limit
+        """
+        body = MultipartStream(fields, source, filename, content_type, size, progress)
+        return self.submit(self._post, body)
+
+    def _post(self, body):
+        # Through send_api, which raises RateLimitError where webex_teams_api would wait and send the same body
+        # again, a body that can only be read once included
+        session = self._backend.send_api._session
+        attempts = 0
+        while True:
+            try:
+                with self._backend.metrics.stage('upload'):
+                    data = session.post('messages', data=body, headers={'Content-Type': body.content_type},
+                                        timeout=self._backend.transport.timeout('upload'))
+                return webexteamssdk.Message(data)
+            except webexteamssdk.exceptions.RateLimitError as error:
+                if not body.replayable or attempts >= self.max_retries:
+                    raise
+                retry_after = float(error.retry_after or 15)
+                log.warning(f'Upload of {body.filename} rate limited by Webex Teams, retrying in {retry_after}s')
+                time.sleep(retry_after)
+                attempts += 1
+
+
+class FrameDecoder():
+    """
+    Turns device websocket frames into activities.
+
+    Frames are parsed straight from bytes with msgspec or orjson when one of them is installed, falling back to the
+    json module. A frame not mentioning conversation.activity is rejected by a substring search before any parsing.
+    With msgspec the frame envelope is decoded against a typed schema, so only eventType and the activity are
+    materialized; the activity itself stays a dict since it is handed to the command handlers as is.
+
+    :param backend: 'msgspec', 'orjson' or 'json', None picks the fastest one installed
+    """
+    ACTIVITY_MARKER = b'"conversation.activity"'
+
+    def __init__(self, backend=None):
+        self._counters = {'decoded': 0, 'filtered': 0, 'ignored': 0}
+        self._decode = None
+        for name in ((backend,) if backend else ('msgspec', 'orjson', 'json')):
+            try:
+                self._decode = getattr(self, f'_{name}_decoder')()
+            except ImportError:
+                continue
+            self.backend = name
+            break
+        if self._decode is None:
+            raise ValueError(f'JSON backend {backend} is not available')
+
+    @staticmethod
+    def _msgspec_decoder():
+        import msgspec
+        from typing import Optional
+
+        class FrameData(msgspec.Struct):
+            eventType: str = ''
+            activity: Optional[dict] = None
+
+        class Frame(msgspec.Struct):
+            data: FrameData
+
+        decoder = msgspec.json.Decoder(Frame)
+
+        def decode(data):
+            frame = decoder.decode(data)
+            return frame.data.eventType, frame.data.activity
+        return decode
+
+    @staticmethod
+    def _envelope(loads):
+        def decode(data):
+            frame = loads(data)['data']
+            return frame.get('eventType', ''), frame.get('activity')
+        return decode
+
+    def _orjson_decoder(self):
+        import orjson
+        return self._envelope(orjson.loads)
+
+    def _json_decoder(self):
+        return self._envelope(json.loads)
+
+    def activity(self, data):
+        """
+        The activity a frame carries, None when it is any other event
+
+        :param data: The frame, as bytes or str
+        """
+        marker = self.ACTIVITY_MARKER if isinstance(data, bytes) else '"conversation.activity"'
+        if marker not in data:
+            self._counters['filtered'] += 1
+            return None
+        event_type, activity = self._decode(data)
+        if event_type != 'conversation.activity' or activity is None:
+            self._counters['ignored'] += 1
+            return None
+        self._counters['decoded'] += 1
+        return activity
+
+    def stats(self):
+        return dict(self._counters, backend=self.backend)
+
+
+class KeepAliveAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTPAdapter keeping up to pool_size connections per host, with TCP keep-alive on its sockets so idle pooled
+    connections are not silently dropped by the network. Threads wait for a free connection rather than opening
+    extra ones that would be discarded afterwards.
+    """
+    __attrs__ = requests.adapters.HTTPAdapter.__attrs__ + ['keepalive_idle']
+
+    def __init__(self, pool_size=10, keepalive_idle=60, pool_block=True, **kwargs):
+        self.keepalive_idle = keepalive_idle
+        super().__init__(pool_connections=4, pool_maxsize=pool_size, pool_block=pool_block, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        import socket
+        from urllib3.connection import HTTPConnection
+
+        options = list(HTTPConnection.default_socket_options) + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keepalive_idle))
+        kwargs['socket_options'] = options
+        super().init_poolmanager(*args, **kwargs)
+
+    def stats(self):
+        """
+        Requests sent and connections opened by the pools of this adapter
+        """
+        sent = opened = 0
+        pools = self.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                sent += pool.num_requests
+                opened += pool.num_connections
+        return {'requests': sent, 'connections': opened, 'reused': max(sent - opened, 0)}
+
+
+class HTTP2Adapter(requests.adapters.BaseAdapter):
+    """
+    Sends the requests of a requests session through an httpx client speaking HTTP/2, which multiplexes the calls to
+    a host over a single connection. Needs httpx installed with its http2 extra.
+    """
+    # Connection specific headers, forbidden in HTTP/2
+    HOP_HEADERS = ('connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'upgrade')
+
+    def __init__(self, pool_size=10):
+        super().__init__()
+        import httpx
+
+        self._httpx = httpx
+        self._client = httpx.Client(http2=True, limits=httpx.Limits(max_connections=pool_size,
+                                                                    max_keepalive_connections=pool_size))
+        self._lock = threading.Lock()
+        self._counters = {'requests': 0, 'http2': 0}
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            timeout = self._httpx.Timeout(read, connect=connect)
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in self.HOP_HEADERS}
+        try:
+            resp = self._client.request(request.method, request.url, headers=headers, content=request.body,
+                                        timeout=timeout)
+        except self._httpx.TimeoutException as error:
+            raise requests.exceptions.Timeout(error, request=request)
+        except self._httpx.TransportError as error:
+            raise requests.exceptions.ConnectionError(error, request=request)
+
+        with self._lock:
+            self._counters['requests'] += 1
+            if resp.http_version == 'HTTP/2':
+                self._counters['http2'] += 1
+
+        response = requests.models.Response()
+        response.status_code = resp.status_code
+        response.headers = requests.structures.CaseInsensitiveDict(resp.headers)
+        response._content = resp.content
+        response.encoding = resp.encoding
+        response.reason = resp.reason_phrase
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        self._client.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        pool = getattr(self._client._transport, '_pool', None)
+        stats['connections'] = len(getattr(pool, 'connections', ()))
+        return stats
+
+
+def make_http_adapter(pool_size=10, http2=False):
+    """
+    The adapter carrying REST calls: HTTP/1.1 with keep-alive, or HTTP/2 through httpx
+    """
+    return HTTP2Adapter(pool_size) if http2 else KeepAliveAdapter(pool_size)
+
+
+class Transport():
+    """
+    The HTTP layer under a webexteamssdk session: mounts a pooled adapter, applies per endpoint timeouts and counts
+    the REST calls per method and endpoint.
+
+    :param session: The webexteamssdk RestSession
+    :param pool_size: Connections kept per host, should match the number of threads making REST calls
+    :param timeouts: (connect, read) timeouts by endpoint, merged with REST_TIMEOUTS
+    :param http2: Use HTTP/2 through httpx
+    :param adapter: An adapter shared with other bots, instead of one of its own
+    """
+    def __init__(self, session, pool_size=10, timeouts=None, http2=False, adapter=None, metrics=None):
+        self.pool_size = pool_size
+        self.timeouts = dict(REST_TIMEOUTS)
+        self.timeouts.update(timeouts or {})
+        self.adapter = adapter or make_http_adapter(pool_size, http2)
+        self._metrics = metrics
+
+        # The session keeps this bot's own Authorization header when the adapter is shared
+        session._req_session.mount('https://', self.adapter)
+        session._req_session.headers['Connection'] = 'keep-alive'
+        request = session.request
+
+        def send(method, url, *args, **kwargs):
+            endpoint = rest_endpoint(url)
+            kwargs.setdefault('timeout', self.timeout(endpoint))
+            if self._metrics is not None:
+                self._metrics.inc('rest_requests', method=method, endpoint=endpoint)
+            return request(method, url, *args, **kwargs)
+
+        session.request = send
+
+    def timeout(self, endpoint):
+        """
+        The (connect, read) timeout of an endpoint, e.g. people/me falls back to people and then to the default
+        """
+        timeout = self.timeouts.get(endpoint)
+        if timeout is None:
+            timeout = self.timeouts.get(endpoint.split('/', 1)[0], self.timeouts[None])
+        return timeout
+
+    def stats(self):
+        """
+        Requests sent, connections opened and how many requests reused an open connection
+        """
+        stats = self.adapter.stats() if hasattr(self.adapter, 'stats') else {}
+        stats['pool_size'] = self.pool_size
+        return stats
+
+
+class CiscoWebexTeamsBackend(ErrBot):
+    """
+    This is the CiscoWebexTeams backend for errbot.
+    """
+
+    wsk = None
+    def __init__(self, token, room_cache_size=1024, room_cache_ttl=300, room_reconcile_interval=900,
+                 person_cache_size=4096, person_cache_ttl=3600, membership_cache_size=256,
+                 membership_cache_ttl=3600, send_workers=4, send_rate=10, send_burst=20, room_send_rate=2,
+                 room_send_burst=5, device_cache=True, device_cache_path=None, person_cache=None, renderer=None,
+                 http_adapter=None, register_device=True, upload_workers=2, metrics=None, json_backend=None,
+                 pool_size=None, concurrency=0, timeouts=None, http2=False):
+        """
+        :param http_adapter: A requests adapter shared with other bots, see make_http_adapter
+        :param pool_size: HTTP connections kept open, by default one per thread making REST calls: the outbox and
+                          upload workers plus concurrency
+        :param concurrency: Number of other threads making REST calls through this backend, e.g. command handlers
+        :param timeouts: (connect, read) timeouts by REST endpoint, see REST_TIMEOUTS
+        :param http2: Make the REST calls over HTTP/2, needs httpx[http2]
+        """
+
+        bot_identity = BOT_IDENTITY = {
+            'TOKEN': token,
+        }
+        self.renderer = renderer or Renderer(rendering.md)
+        self.metrics = metrics or Metrics()
+        self.decoder = FrameDecoder(json_backend)
+        self.startup_timings = {}
+        started = time.monotonic()
+        self.room_cache = TTLCache(maxsize=room_cache_size, ttl=room_cache_ttl)
+        self.room_index = RoomIndex(self, reconcile_interval=room_reconcile_interval)
+        self.person_cache = person_cache or PersonCache(self, maxsize=person_cache_size, ttl=person_cache_ttl)
+        self.membership_cache = TTLCache(maxsize=membership_cache_size, ttl=membership_cache_ttl)
+        self.dedup = DedupWindow()
+
+        # Do we have the basic mandatory config needed to operate the bot
+        self._bot_token = bot_identity.get('TOKEN', None)
+        if not self._bot_token:
+            log.fatal('You need to define the Cisco Webex Teams Bot TOKEN in the BOT_IDENTITY of config.py.')
+            sys.exit(1)
+
+        # The device name is derived from the token so every run of this bot looks for the same device
+        token_hash = hashlib.sha256(self._bot_token.encode('utf-8')).hexdigest()
+        self.device_data = dict(DEVICE_DATA, name=f"python-webex-teams-client-{token_hash[:10]}")
+        self.device_cache_path = None
+        if device_cache:
+            self.device_cache_path = device_cache_path or os.path.join(DEVICE_CACHE_DIR, f"device-{token_hash[:16]}.json")
+
+        log.debug('Setting up the Webex Teams API')
+        self.webex_teams_api = webexteamssdk.WebexTeamsAPI(access_token=self._bot_token)
+        if pool_size is None:
+            # The bootstrap and room index threads need a couple more
+            pool_size = send_workers + upload_workers + concurrency + 2
+        self.transport = Transport(self.webex_teams_api._session, pool_size=pool_size, timeouts=timeouts,
+                                   http2=http2, adapter=http_adapter, metrics=self.metrics)
+        # The outbox handles 429s itself, pausing its rate limiters, so its client must raise them instead of
+        # sleeping inside messages.create. It shares the connection pool of the main client.
+        self.send_api = webexteamssdk.WebexTeamsAPI(access_token=self._bot_token, wait_on_rate_limit=False)
+        Transport(self.send_api._session, pool_size=pool_size, timeouts=self.transport.timeouts,
+                  adapter=self.transport.adapter, metrics=self.metrics)
+
+        self.uploads = UploadPool(self, workers=upload_workers)
+        self.outbox = Outbox(self, workers=send_workers, rate=send_rate, burst=send_burst, room_rate=room_send_rate,
+                             room_burst=room_send_burst)
+        self.metrics.gauge('outbox_queue_depth', lambda: self.outbox.queue_depth)
+
+        # The device registration and the bot's own identity are independent, fetch them concurrently
+        log.debug('Setting up the device on Webex Teams and fetching the identifier of the bot itself')
+        with ThreadPoolExecutor(max_workers=2) as bootstrap:
+            # Worker processes only make REST calls and need no device
+            device = bootstrap.submit(self._timed, 'device', self._get_device_info) if register_device else None
+            me = bootstrap.submit(self._timed, 'me', self.webex_teams_api.people.me)
+            self.device_info = device.result() if device is not None else None
+            self.bot_identifier = CiscoWebexTeamsPerson(self, me.result())
+        self.person_cache.add(self.bot_identifier.teams_person)
+        self.startup_timings['total'] = time.monotonic() - started
+
+        log.info('Connected to Webex Teams',
+                 extra={'fields': {'bot': self.bot_identifier.email, 'timings': self.startup_timings}})
+
+        self._register_identifiers_pickling()
+
+    @property
+    def md(self):
+        """The errbot markdown converter, created on first use"""
+        return self.renderer.md
+
+    def _timed(self, name, func):
+        started = time.monotonic()
+        try:
+            return func()
+        finally:
+            self.startup_timings[name] = time.monotonic() - started
+
+    @property
+    def mode(self):
+        return 'CiscoWebexTeams'
+
+    def is_from_self(self, message):
+      return message.frm.id == message.to.id
+
+    def process_websocket(self, message):
+        """
+        Process the data from the websocket and determine if we need to ack on it
+        :param message: The message received from the websocket
+        :return:
+        """
+        activity = self.decoder.activity(message)
+        if activity is None:
+            frames_log.debug('Ignoring event that is not a conversation activity')
+            return
+
+        if self.dedup.seen(activity['id']):
+            frames_log.debug('Ignoring activity delivered more than once', extra={'fields': {'id': activity['id']}})
+            return
+        self.handle_room_event(activity)
+
+        if activity['verb'] != 'post':
+            frames_log.debug('Ignoring activity', extra={'fields': {'id': activity['id'], 'verb': activity['verb']}})
+            return
+
+        spark_message = self.webex_teams_api.messages.get(activity['id'])
+
+        if spark_message.personEmail in self.bot_identifier.emails:
+            messages_log.debug('Ignoring message from myself', extra={'fields': {'id': spark_message.id}})
+            return
+
+        messages_log.debug('Message received', extra={'fields': {'id': spark_message.id,
+                                                                 'roomId': spark_message.roomId}})
+        self.callback_message(self.get_message(spark_message))
+
+    def fetch_room(self, room_id):
+        """
+        Return the webexteamssdk Room for an ID, from the room cache when possible
+
+        :raises webexteamssdk.ApiError: when the room cannot be fetched
+        """
+        key = webex_uuid(room_id)
+        room = self.room_cache.get(key)
+        if room is None:
+            room = self.webex_teams_api.rooms.get(room_id)
+            self.room_cache.put(key, room)
+        return room
+
+    def get_light(self, resource, item_id, model):
+        """
+        Fetch a REST object as a WebexObject, skipping the webexteamssdk model construction
+
+        :param resource: The REST resource, e.g. messages or attachment/actions
+        :param item_id: ID of the object
+        :param model: webexteamssdk model class built if a handler reads .sdk
+        """
+        return WebexObject(self.webex_teams_api._session.get(f'{resource}/{item_id}'), model)
+
+    def handle_room_event(self, activity):
+        """
+        Drop cached data about a room when a websocket activity changes the room or its membership
+        """
+        if activity['verb'] in ROOM_EVENT_VERBS:
+            target = activity.get('target') or activity.get('object') or {}
+            if target.get('id'):
+                self.room_cache.invalidate(webex_uuid(target['id']))
+                self.room_index.schedule_refresh(target['id'])
+
+                obj = activity.get('object') or {}
+                if obj.get('objectType') == 'person' and activity['verb'] in ('add', 'leave'):
+                    snapshot = self.membership_cache.get(webex_uuid(target['id']))
+                    if snapshot is not None:
+                        if activity['verb'] == 'add':
+                            snapshot.add(obj['id'], obj.get('emailAddress'))
+                        else:
+                            snapshot.remove(obj['id'])
+
+    def handle_room_webhook(self, resource, event, data):
+        """
+        Drop cached data about a room when a rooms or memberships webhook reports a change
+
+        :param resource: The webhook resource, rooms or memberships
+        :param event: The webhook event, created, updated or deleted
+        :param data: The data member of the webhook payload
+        """
+        if resource == 'rooms':
+            room_id = data['id']
+        elif resource == 'memberships':
+            room_id = data['roomId']
+            snapshot = self.membership_cache.get(webex_uuid(room_id))
+            if snapshot is not None:
+                if event == 'created':
+                    snapshot.add(data['personId'], data.get('personEmail'))
+                elif event == 'deleted':
+                    snapshot.remove(data['personId'])
+        else:
+            return
+        self.room_cache.invalidate(webex_uuid(room_id))
+        self.room_index.schedule_refresh(room_id)
+
+    def membership_snapshot(self, room_id):
+        """
+        Return the cached MembershipSnapshot of a room, loading it from memberships.list() if needed
+        """
+        key = webex_uuid(room_id)
+        snapshot = self.membership_cache.get(key)
+        if snapshot is None:
+            snapshot = MembershipSnapshot(room_id)
+            for membership in self.webex_teams_api.memberships.list(roomId=room_id):
+                snapshot.add(membership.personId, membership.personEmail)
+            self.membership_cache.put(key, snapshot)
+        return snapshot
+
+    def http_stats(self):
+        """
+        Connection pool size and reuse of the REST transport
+        """
+        return self.transport.stats()
+
+    def cache_stats(self):
+        """
+        Hit, miss and size statistics of the backend caches
+        """
+        return {'rooms': self.room_cache.stats(), 'people': self.person_cache.stats(),
+                'memberships': self.membership_cache.stats()}
+
+    def warm_people(self, person_ids):
+        """
+        Preload the person cache, batching the IDs into people.list() calls
+
+        :param person_ids: Webex Teams person IDs
+        :return: Number of people loaded
+        """
+        return self.person_cache.warm(person_ids)
+
+    def get_message(self, message):
+        """
+        Create an errbot message object
+        """
+        person = CiscoWebexTeamsPerson(self)
+        person.id = message.id
+        person.email = message.personEmail
+        try:
+            parentId = message.parentId
+        except AttributeError:
+            parentId = message.id
+
+        room = CiscoWebexTeamsRoom(backend=self, room_id=message.roomId)
+        occupant = CiscoWebexTeamsRoomOccupant(self, person=person, room=room)
+        msg = CiscoWebexTeamsMessage(body=message.markdown or message.text,
+                                     frm=occupant,
+                                     to=room,
+                                     extras={'roomType': message.roomType,'parentId': parentId})
+        return msg
+
+    def follow_room(self, room):
+        """
+        Backend: Follow Room yet to be implemented
 
         :param room:
         :return:
@@ -470,7 +2102,7 @@ class CiscoWebexTeamsBackend(ErrBot):
         :return:
             List of rooms
         """
-        return [f"{room.title} ({room.type})" for room in self.webex_teams_api.rooms.list()]
+        return [f"{room.title} ({room.type})" for room in self.room_index.all()]
 
     def contacts(self):
         """
@@ -503,6 +2135,7 @@ class CiscoWebexTeamsBackend(ErrBot):
             :class: CiscoWebexTeamsRoom
         """
         if isinstance(room_id_or_name, webexteamssdk.Room):
+            self.room_cache.put(webex_uuid(room_id_or_name.id), room_id_or_name)
             return CiscoWebexTeamsRoom(backend=self, room_id=room_id_or_name.id)
 
         # query_room can provide us either a room name of an ID, so we need to check
@@ -517,10 +2150,7 @@ class CiscoWebexTeamsBackend(ErrBot):
     def send_card(self, card):
         """Send a card out to Webex Teams."""
 
-        # Need to strip out "markdown extra" as not supported by Webex Teams
-        md = markdown(self.md.convert(card.body),
-                      extensions=['markdown.extensions.nl2br',
-                                  'markdown.extensions.fenced_code'])
+        md = self.renderer.markdown(card.body)
 
         payload = {
             "text": card.body,
@@ -537,7 +2167,7 @@ class CiscoWebexTeamsBackend(ErrBot):
         else:
             payload["roomId"] = card.to.room.id
 
-        self.webex_teams_api.messages.create(**payload)
+        self.outbox.send(payload)
 
     def send_message(self):#, mess):
         """
@@ -558,46 +2188,64 @@ class CiscoWebexTeamsBackend(ErrBot):
         #else:
         self.webex_teams_api.messages.create(roomId=roomid, text="TEST")#, markdown=md)
 
-    def _teams_upload(self, stream):
+    def _teams_upload(self, stream, progress=None):
         """
         Performs an upload defined in a stream
-        :param stream: Stream object
+        :param stream: Stream object, read in chunks so its transfered count follows the upload
+        :param progress: Optional callable called with (bytes sent, total size or None)
         :return: None
         """
 
         try:
             stream.accept()
-            log.exception(f'Upload of {stream.raw.name} to {stream.identifier} has started.')
+            log.debug(f'Upload of {stream.name} to {stream.identifier} has started.')
 
             if type(stream.identifier) == CiscoWebexTeamsPerson:
-                self.webex_teams_api.messages.create(toPersonId=stream.identifier.id, files=[stream.raw.name])
+                fields = {'toPersonId': stream.identifier.id}
+            else:
+                fields = {'roomId': stream.identifier.room.id}
+            if hasattr(stream, 'raw') and stream.seekable():
+                # A BufferedReader over a seekable file: the body can be read again if the upload is retried
+                source = stream
             else:
-                self.webex_teams_api.messages.create(roomId=stream.identifier.room.id, files=[stream.raw.name])
+                # Older errbot Streams are a BytesIO proxying reads to the source, so their own seek/tell say
+                # nothing about the file: hand it over as plain chunks and let the size decide on chunked encoding.
+                source = iter(lambda: stream.read(64 * 1024), b'')
+            body = MultipartStream(fields, source, filename=stream.name, size=stream.size, progress=progress)
+            self.uploads._post(body)
 
             stream.success()
-            log.exception(f'Upload of {stream.raw.name} to {stream.identifier} has completed.')
+            log.debug(f'Upload of {stream.name} to {stream.identifier} has completed.')
 
         except Exception:
             stream.error()
-            log.exception(f'Upload of {stream.raw.name} to {stream.identifier} has failed.')
+            log.exception(f'Upload of {stream.name} to {stream.identifier} has failed.')
 
         finally:
             stream.close()
 
-    def send_stream_request(self, identifier, fsource, name='file', size=None, stream_type=None):
+    def send_stream_request(self, identifier, fsource, name='file', size=None, stream_type=None, progress=None):
         """
         Send a file to Cisco Webex Teams
 
+        The upload runs on the backend's upload pool, the returned Stream reports its progress and outcome.
+
         :param user: is the identifier of the person you want to send it to.
         :param fsource: is a file object you want to send.
         :param name: is an optional filename for it.
-        :param size: not supported in Webex Teams backend
+        :param size: size of the file, found from fsource when not given
         :param stream_type: not supported in Webex Teams backend
+        :param progress: Optional callable called with (bytes sent, total size or None)
         """
-        log.debug(f'Requesting upload of {fsource.name} to {identifier}.')
+        log.debug(f'Requesting upload of {name} to {identifier}.')
+        if size is None and hasattr(fsource, 'seekable') and fsource.seekable():
+            start = fsource.tell()
+            size = fsource.seek(0, os.SEEK_END) - start
+            fsource.seek(start)
+        if size is not None and size > CISCO_WEBEX_TEAMS_FILE_SIZE_LIMIT:
+            raise FileTooLarge(f'{name} is {size} bytes, Webex Teams accepts at most {CISCO_WEBEX_TEAMS_FILE_SIZE_LIMIT}')
         stream = Stream(identifier, fsource, name, size, stream_type)
-#        self.thread_pool.apply_async(self._teams_upload, (stream,))
-        self._teams_upload(stream)
+        self.uploads.submit(self._teams_upload, stream, progress)
         return stream
 
     def build_reply(self, mess, text=None, private=False, threaded=False):
@@ -622,16 +2270,27 @@ class CiscoWebexTeamsBackend(ErrBot):
         super().disconnect_callback()
 
     def on_msg(self):
-        print("Message Received")
+        frames_log.debug('Message received')
 
     def on_err(self):
-        print("ERROR")
+        connection_log.error('Websocket error')
 
     def on_open(self):
-        print("OPENED")
+        connection_log.info('Websocket opened')
 
     def on_close(self):
-        print("CLOSING.....")
+        connection_log.info('Websocket closing')
+
+    def _authorization_frame(self):
+        """
+        The frame sent on a freshly opened device websocket to authenticate it
+        """
+        return {'id': str(uuid.uuid4()),
+                'type': 'authorization',
+                'data': {
+                         'token': 'Bearer ' + self._bot_token
+                        }
+               }
 
     async def serve_once(self):
         """
@@ -639,50 +2298,110 @@ class CiscoWebexTeamsBackend(ErrBot):
         """
         try:
             url = self.device_info['webSocketUrl']
-            print("Opening websocket connection to %s" % websocket)
-            websocket.enableTrace(True)
-            #ws = websocket.create_connection(url)
-            #in_data = ws.recv()
-            #print(in_data)
-            async with websocket.WebSocketApp(url,on_message=self.on_msg,on_error=self.on_err,on_close=self.on_close) as self.wsk:
-                self.wsk.on_open = self.on_open
-                print("Ging to RUN forever")
-            #    self.wsk.run_forever(http_proxy_host="proxy-wsa.esl.cisco.com", http_proxy_port=80)
+            connection_log.debug('Opening websocket connection', extra={'fields': {'url': url}})
+            loop = asyncio.get_running_loop()
+            async with websockets.connect(url) as self.wsk:
+                await self.wsk.send(json.dumps(self._authorization_frame()))
+                async for in_data in self.wsk:
+                    if isinstance(in_data, str):
+                        in_data = in_data.encode('utf-8')
+                    # process_websocket makes blocking REST calls, keep them off the event loop
+                    await loop.run_in_executor(None, self.process_websocket, in_data)
         except KeyboardInterrupt:
-            print("Interrupt received, shutting down..")
+            log.info('Interrupt received, shutting down')
             return True
 
-    def _get_device_info(self):
+    def _get_device_info(self, refresh=False, refused=None):
         """
         Setup device in Webex Teams to bridge events across websocket
+
+        The device is read from the local device cache when there is one, costing no REST call. It is only
+        validated when the websocket is opened, see refresh_device. Otherwise the device registered under this bot's
+        name is reused, and a new one is only created when there is none. Devices left behind by earlier versions
+        are deleted on the way.
+
+        :param refresh: Ignore the local device cache
+        :param refused: URL of a device whose websocket was refused, deleted rather than reused
         :return:
         """
-        logging.debug('Getting device list from Webex Teams')
+        if not refresh:
+            device = self._load_cached_device()
+            if device is not None:
+                log.debug(f'Using cached Webex Teams device {device["name"]}')
+                self.device_info = device
+                return device
+
+        log.debug('Getting device list from Webex Teams')
 
         try:
-            print(DEVICES_URL)
             resp = self.webex_teams_api._session.get(DEVICES_URL)
+            reusable = None
             for device in resp['devices']:
-                print(device['name'])
-                if device['name'] == DEVICE_DATA['name']:
-                    self.device_info = device
-                    return device
-                else:
-                    resp = self.webex_teams_api._session.delete(DEVICES_URL)
-                    print(resp)
+                if device.get('url') == refused or LEGACY_DEVICE_NAME.fullmatch(device['name']):
+                    self._delete_device(device)
+                elif reusable is None and device['name'] == self.device_data['name']:
+                    reusable = device
+            if reusable is not None:
+                self.device_info = reusable
+                self._save_cached_device(reusable)
+                return reusable
 
         except webexteamssdk.ApiError:
             pass
 
-        print('Device does not exist in Webex Teams, creating')
+        log.info('Device does not exist in Webex Teams, creating', extra={'fields': {'name': self.device_data['name']}})
 
-        resp = self.webex_teams_api._session.post(DEVICES_URL, json=DEVICE_DATA)
+        resp = self.webex_teams_api._session.post(DEVICES_URL, json=self.device_data)
         if resp is None:
             raise FailedToCreateWebexDevice("Could not create Webex Teams device using {}".format(DEVICES_URL))
 
         self.device_info = resp
+        self._save_cached_device(resp)
         return resp
 
+    def refresh_device(self):
+        """
+        Re-register the device after its websocket was refused, e.g. because Webex Teams expired it
+        """
+        log.warning('Webex Teams device rejected, registering it again')
+        refused = (self.device_info or {}).get('url')
+        return self._get_device_info(refresh=True, refused=refused)
+
+    def _delete_device(self, device):
+        log.info('Deleting Webex Teams device', extra={'fields': {'name': device['name']}})
+        try:
+            self.webex_teams_api._session.delete(device['url'])
+        except webexteamssdk.ApiError as error:
+            # The session expects a 204, a 200 is a success too
+            if error.response.status_code >= 300:
+                log.warning(f'Failed to delete Webex Teams device {device["name"]}: {error!r}')
+
+    def _load_cached_device(self):
+        if self.device_cache_path is None or not os.path.exists(self.device_cache_path):
+            return None
+        try:
+            with open(self.device_cache_path) as f:
+                device = json.load(f)
+        except (OSError, ValueError):
+            log.warning(f'Ignoring unreadable device cache {self.device_cache_path}')
+            return None
+        if device.get('name') != self.device_data['name'] or 'webSocketUrl' not in device:
+            return None
+        return device
+
+    def _save_cached_device(self, device):
+        if self.device_cache_path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.device_cache_path), exist_ok=True)
+            tmp = self.device_cache_path + '.tmp'
+            # The device URL is only usable with the bot token, but keep the file private anyway
+            with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump(device, f)
+            os.replace(tmp, self.device_cache_path)
+        except OSError:
+            log.exception(f'Failed to write device cache {self.device_cache_path}')
+
     def change_presence(self, status=OFFLINE, message=''):
         """
         Backend: Change presence yet to be implemented
@@ -751,63 +2470,973 @@ class CiscoWebexTeamsBackend(ErrBot):
         """
         return self.recall(id).get(key)
 
+    # build_identifier of every backend in the process, by the ID of its bot, so identifiers are unpickled by the
+    # backend they were created by when several bots run in one process
+    _identifier_builders = {}
+
     @staticmethod
-    def _unpickle_identifier(identifier_str):
-        return CiscoWebexTeamsBackend.__build_identifier(identifier_str)
+    def _unpickle_identifier(identifier_str, bot_id=None):
+        builders = CiscoWebexTeamsBackend._identifier_builders
+        if bot_id in builders:
+            return builders[bot_id](identifier_str)
+        if len(builders) == 1:
+            # Pickled before identifiers recorded their bot, or by a bot this process does not run
+            return next(iter(builders.values()))(identifier_str)
+        raise ValueError(f'No backend to unpickle {identifier_str} with, bot {bot_id} is not running')
 
     @staticmethod
     def _pickle_identifier(identifier):
-        return CiscoWebexTeamsBackend._unpickle_identifier, (str(identifier),)
+        return CiscoWebexTeamsBackend._unpickle_identifier, (str(identifier), identifier._backend.bot_identifier.id)
 
     def _register_identifiers_pickling(self):
         """
         Register identifiers pickling.
         """
-        CiscoWebexTeamsBackend.__build_identifier = self.build_identifier
+        CiscoWebexTeamsBackend._identifier_builders[self.bot_identifier.id] = self.build_identifier
         for cls in (CiscoWebexTeamsPerson, CiscoWebexTeamsRoomOccupant, CiscoWebexTeamsRoom):
             copyreg.pickle(cls, CiscoWebexTeamsBackend._pickle_identifier, CiscoWebexTeamsBackend._unpickle_identifier)
 
     async def __aexit__(self, exc_type, exc, tb):
-        print("EXITING")
+        log.debug('Exiting')
 
-class FireBot():
+class CommandDispatcher():
+    """
+    Run command handlers on a fixed pool of worker threads, each fed from its own bounded queue.
 
-    commands={}
-    token=""
-    bot = None
-    def __init__(self, token):
-        self.token = token
-        self.commands["help"]=[self.helpme, "List all commands"]
-        print(token)
+    Jobs submitted with the same key, the conversation they belong to, always go to the same worker and so run one
+    after the other in submission order; jobs of different conversations run concurrently. Handlers registered with
+    process=True are handed to a process pool instead, for CPU heavy work. Such handlers
+    must be module level functions and their arguments must be picklable.
+    """
+    def __init__(self, workers=8, max_queue=256, policy=DISPATCH_BLOCK, processes=0, block_timeout=None,
+                 on_reject=None):
+
+        if policy not in (DISPATCH_BLOCK, DISPATCH_DROP, DISPATCH_REJECT):
+            raise ValueError(f"Unknown overload policy {policy}")
+
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.on_reject = on_reject
+        self._queues = [queue.Queue(maxsize=max(1, max_queue // workers)) for _ in range(workers)]
+        self._next = 0
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._counters = {'submitted': 0, 'completed': 0, 'failed': 0, 'dropped': 0, 'rejected': 0}
+        self._process_pool = ProcessPoolExecutor(max_workers=processes, mp_context=_process_context) if processes else None
+
+        self._workers = []
+        for i, q in enumerate(self._queues):
+            x = threading.Thread(target=self._work, args=(q,), name=f"firebot-worker-{i}", daemon=True)
+            x.start()
+            self._workers.append(x)
 
-    def helpme(self, *argv):
-        msg = argv[0]
-        helpdoc = "Here are the available commands :\n"
-        for cmd,helper in self.commands.items():
-            if cmd!="cardaction":
-                helpdoc+='{} : {}'.format(cmd, helper[1])+"\n"
-        self.send_message(msg.roomId, helpdoc)
+    @property
+    def workers(self):
+        """Number of worker threads"""
+        return len(self._workers)
 
-    def add_command(self, command, func, helper=None):
-        if command is None or func is None:
-            return 0
-        else:
-            print("ADDING COMMAND")
-            if isinstance(func, str):
-                func = eval(func)
-            self.commands[command.lower()]=[func, helper]
-            print(self.commands)
+    @property
+    def queue_depth(self):
+        """Number of jobs waiting for a free worker"""
+        return sum(q.qsize() for q in self._queues)
 
-    def process_command(self, txt, msg):
-        print(txt)
-        if txt in self.commands:
-            return self.commands[txt][0]
+    @property
+    def in_flight(self):
+        """Number of jobs currently being run by a worker"""
+        return self._in_flight
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['in_flight'] = self._in_flight
+        stats['queue_depth'] = self.queue_depth
+        return stats
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def submit(self, func, args=(), reply_to=None, process=False, on_reject=None, on_done=None, key=None):
+        """
+        Queue a handler call
+
+        :param func: The handler to run
+        :param args: Positional arguments for the handler
+        :param reply_to: Room ID passed to on_reject when the job is rejected
+        :param process: Run the handler in the process pool
+        :param on_reject: Overrides the dispatcher's on_reject for this job, for dispatchers shared by several bots
+        :param on_done: Called with the seconds the handler ran and the exception it raised, or None
+        :param key: Jobs with the same key run in order on the same worker, e.g. activity_room_key(activity).
+                    Jobs without one are spread over the workers
+        :return: True if the job was queued, False if it was dropped or rejected
+        """
+        if process and self._process_pool is None:
+            raise ValueError("Dispatcher was created without a process pool")
+
+        if key is None:
+            with self._lock:
+                self._next += 1
+                q = self._queues[self._next % len(self._queues)]
+        else:
+            q = self._queues[hash(key) % len(self._queues)]
+
+        job = (func, args, process, on_done)
+        try:
+            if self.policy == DISPATCH_BLOCK:
+                q.put(job, timeout=self.block_timeout)
+            else:
+                q.put_nowait(job)
+        except queue.Full:
+            if self.policy == DISPATCH_REJECT:
+                self._count('rejected')
+                log.warning(f'Dispatcher queue full, rejecting {getattr(func, "__name__", func)}')
+                on_reject = on_reject or self.on_reject
+                if on_reject is not None and reply_to is not None:
+                    try:
+                        on_reject(reply_to)
+                    except Exception:
+                        log.exception('Failed to send overload reply')
+            else:
+                self._count('dropped')
+                log.warning(f'Dispatcher queue full, dropping {getattr(func, "__name__", func)}')
+            return False
+
+        self._count('submitted')
+        return True
+
+    def _work(self, q):
+        while True:
+            job = q.get()
+            if job is None:
+                q.task_done()
+                return
+
+            func, args, process, on_done = job
+            with self._lock:
+                self._in_flight += 1
+            error = None
+            started = time.perf_counter()
+            try:
+                if process:
+                    self._process_pool.submit(func, *args).result()
+                elif asyncio.iscoroutinefunction(func):
+                    asyncio.run(func(*args))
+                else:
+                    func(*args)
+                self._count('completed')
+            except Exception as e:
+                error = e
+                self._count('failed')
+                log.exception(f'Command handler {getattr(func, "__name__", func)} failed')
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                q.task_done()
+                if on_done is not None:
+                    try:
+                        on_done(time.perf_counter() - started, error)
+                    except Exception:
+                        log.exception('on_done callback failed')
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers once the jobs already queued have run
+        """
+        for q in self._queues:
+            q.put(None)
+        if wait:
+            for x in self._workers:
+                x.join()
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=wait)
+
+
+class ActivityLanes():
+    """
+    Run a callable for websocket activities on a fixed number of lanes.
+
+    Every activity with the same key (the conversation it belongs to) is sent down the same lane, so activities of a
+    single room are handled in the order they were received while different rooms are handled concurrently.
+    """
+    def __init__(self, handler, lanes=4, max_queue=256):
+        self._handler = handler
+        self._queues = [queue.Queue(maxsize=max_queue) for _ in range(lanes)]
+        self._threads = []
+        for i, q in enumerate(self._queues):
+            x = threading.Thread(target=self._work, args=(q,), name=f"firebot-lane-{i}", daemon=True)
+            x.start()
+            self._threads.append(x)
+
+    @property
+    def queue_depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def submit(self, key, activity):
+        """
+        Queue an activity on the lane owning key, blocking while that lane is full
+        """
+        self._queues[hash(key) % len(self._queues)].put(activity)
+
+    def _work(self, q):
+        while True:
+            activity = q.get()
+            if activity is None:
+                return
+            try:
+                self._handler(activity)
+            except Exception:
+                log.exception(f'Failed to handle activity {activity.get("id")}')
+
+    def shutdown(self):
+        for q in self._queues:
+            q.put(None)
+
+
+class TokenBucket():
+    """
+    Allows rate operations per second on average, with bursts of up to capacity
+    """
+    __slots__ = ('rate', 'capacity', '_tokens', '_updated', '_paused_until')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+
+    def delay(self):
+        """
+        Seconds to wait before a token is available, 0 if one is available now
+        """
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def take(self):
+        self._tokens -= 1
+
+    def pause(self, seconds):
+        """
+        Hand out no token for the next seconds, e.g. after a 429 with a Retry-After header
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class Outbox():
+    """
+    Central queue for messages.create calls.
+
+    Sends are made by a pool of worker threads sharing the backend's send_api client, which raises RateLimitError
+    rather than waiting. Messages are queued per destination room and a room has at most one send in flight, so
+    messages to a room go out in the order they were submitted. A token bucket for the bot token and one per room
+    keep the send rate under the Webex Teams limits, and a 429 response pauses both buckets for the Retry-After
+    period and puts the message back at the front of its room's queue, holding back the other workers too.
+    """
+    def __init__(self, backend, workers=4, rate=10, burst=20, room_rate=2, room_burst=5, max_retries=5):
+        self._backend = backend
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(rate, burst)
+        self._room_rate = room_rate
+        self._room_burst = room_burst
+        self._room_buckets = TTLCache(maxsize=4096, ttl=600)
+        # Pending jobs by room, and the rooms that can be sent to next ordered by when. A room with a send in
+        # flight has jobs in _rooms but is not in _heap until that send is done
+        self._rooms = {}
+        self._heap = []
+        self._seq = 0
+        self._depth = 0
+        self._cond = threading.Condition()
+        self._counters = {'queued': 0, 'sent': 0, 'failed': 0, 'rate_limited': 0}
+        self._latency = {'count': 0, 'total': 0.0, 'max': 0.0}
+
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"firebot-outbox-{i}", daemon=True).start()
+
+    def submit(self, payload):
+        """
+        Queue a messages.create call
+
+        :param payload: Keyword arguments for messages.create
+        :return: A concurrent.futures.Future resolved with the created message
+        """
+        future = Future()
+        now = time.monotonic()
+        key = self._room_key(payload)
+        with self._cond:
+            jobs = self._rooms.get(key)
+            if jobs is None:
+                jobs = self._rooms[key] = deque()
+                self._push(now, key)
+            jobs.append([payload, future, now, 0])
+            self._depth += 1
+            self._counters['queued'] += 1
+            self._cond.notify()
+        return future
+
+    def send(self, payload, timeout=None):
+        """
+        Queue a messages.create call and wait for the created message
+        """
+        return self.submit(payload).result(timeout)
+
+    @staticmethod
+    def _room_key(payload):
+        return payload.get('roomId') or payload.get('toPersonId') or payload.get('toPersonEmail')
+
+    def _push(self, not_before, key):
+        self._seq += 1
+        heapq.heappush(self._heap, (not_before, self._seq, key))
+
+    def _room_bucket(self, key):
+        bucket = self._room_buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self._room_rate, self._room_burst)
+            self._room_buckets.put(key, bucket)
+        return bucket
+
+    def _next_job(self):
+        """
+        Wait for a room whose bucket and the bot token's both have a token available, take them and the room's
+        next job. The room is not handed to another worker until _release is called for it
+        """
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                not_before, _, key = self._heap[0]
+                now = time.monotonic()
+                if not_before > now:
+                    self._cond.wait(not_before - now)
+                    continue
+
+                heapq.heappop(self._heap)
+                room_bucket = self._room_bucket(key)
+                wait = max(self._bucket.delay(), room_bucket.delay())
+                if wait:
+                    self._push(now + wait, key)
+                    continue
+                self._bucket.take()
+                room_bucket.take()
+                self._depth -= 1
+                return key, self._rooms[key].popleft(), room_bucket
+
+    def _release(self, key, retry=None, delay=0):
+        """
+        Let the next job of a room be sent, after delay seconds. A job to retry goes back to the front of the room
+        """
+        with self._cond:
+            jobs = self._rooms[key]
+            if retry is not None:
+                jobs.appendleft(retry)
+                self._depth += 1
+            if jobs:
+                self._push(time.monotonic() + delay, key)
+                self._cond.notify()
+            else:
+                del self._rooms[key]
+
+    def _work(self):
+        while True:
+            key, job, room_bucket = self._next_job()
+            payload, future, queued_at, attempts = job
+            if attempts == 0:
+                if not future.set_running_or_notify_cancel():
+                    self._release(key)
+                    continue
+                self._record_latency(time.monotonic() - queued_at)
+            try:
+                with self._backend.metrics.stage('send'):
+                    result = self._backend.send_api.messages.create(**payload)
+            except webexteamssdk.exceptions.RateLimitError as error:
+                if attempts < self.max_retries:
+                    retry_after = float(error.retry_after or 15)
+                    log.warning(f'Rate limited by Webex Teams, retrying in {retry_after}s')
+                    with self._cond:
+                        self._counters['rate_limited'] += 1
+                        self._bucket.pause(retry_after)
+                        room_bucket.pause(retry_after)
+                    self._release(key, [payload, future, queued_at, attempts + 1], retry_after)
+                    continue
+                self._release(key)
+                self._fail(future, error)
+            except Exception as error:
+                self._release(key)
+                self._fail(future, error)
+            else:
+                self._release(key)
+                with self._cond:
+                    self._counters['sent'] += 1
+                future.set_result(result)
+
+    def _fail(self, future, error):
+        with self._cond:
+            self._counters['failed'] += 1
+        log.error(f'Failed to send message: {error!r}')
+        future.set_exception(error)
+
+    def _record_latency(self, latency):
+        with self._cond:
+            self._latency['count'] += 1
+            self._latency['total'] += latency
+            self._latency['max'] = max(self._latency['max'], latency)
+
+    @property
+    def queue_depth(self):
+        return self._depth
+
+    def stats(self):
+        """
+        Send counters, queue depth and the time messages spent queued before their first send attempt
+        """
+        with self._cond:
+            stats = dict(self._counters)
+            stats['queue_depth'] = self._depth
+            count = self._latency['count']
+            stats['queue_latency_avg'] = self._latency['total'] / count if count else 0.0
+            stats['queue_latency_max'] = self._latency['max']
+        return stats
+
+
+class CommandRoute():
+    """
+    A command registered with FireBot.add_command
+    """
+    __slots__ = ('name', 'func', 'helper', 'process', 'aliases', 'args')
+
+    def __init__(self, name, func, helper=None, process=False, aliases=(), args=None):
+        self.name = name
+        self.func = func
+        self.helper = helper
+        self.process = process
+        self.aliases = tuple(aliases)
+        self.args = re.compile(args, re.IGNORECASE | re.DOTALL) if isinstance(args, str) else args
+
+    def parse_args(self, text):
+        """
+        Parse the text following the command.
+
+        With a regex, the text must match it fully and its named groups (or its groups when it has none) are
+        returned, None meaning it did not match. With args=True the whitespace separated words are returned.
+        """
+        if self.args is True:
+            return text.split()
+        match = self.args.fullmatch(text)
+        if match is None:
+            return None
+        return match.groupdict() or match.groups()
+
+
+class CommandRouter():
+    """
+    Matches message text against every registered command, alias and argument pattern with a single compiled regex.
+
+    A leading mention of the bot, by full display name or first name, is stripped by a second regex compiled once
+    the bot's display name is known.
+    """
+    def __init__(self):
+        self._routes = {}
+        self._groups = {}
+        self._pattern = None
+        self._mention = None
+
+    def add(self, route):
+        self._routes[route.name] = route
+        self._compile()
+
+    def remove(self, name):
+        self._routes.pop(name, None)
+        self._compile()
+
+    def _compile(self):
+        names = []
+        for route in self._routes.values():
+            for name in (route.name,) + route.aliases:
+                names.append((name, route))
+        # Spaces in a command are ignored, as is any space typed between its letters: "card command", "cardcommand"
+        # and "cardc ommand" all ask for the same command
+        names = [(name.replace(' ', ''), route) for name, route in names]
+        # Longest first so that a command is never shadowed by another one that is a prefix of it
+        names.sort(key=lambda item: len(item[0]), reverse=True)
+
+        self._groups = {}
+        alternatives = []
+        for i, (name, route) in enumerate(names):
+            self._groups[f'c{i}'] = route
+            alternatives.append(f'(?P<c{i}>{"[ ]*".join(re.escape(char) for char in name)})')
+        if alternatives:
+            self._pattern = re.compile(r'\s*(?:' + '|'.join(alternatives) + r')(?:\s+(?P<argtext>.*?))?\s*',
+                                       re.IGNORECASE | re.DOTALL)
+        else:
+            self._pattern = None
+
+    def set_mention(self, display_name):
+        """
+        Compile the regex stripping a leading mention of the bot from message text
+        """
+        names = {display_name, display_name.split(" ")[0]}
+        names = sorted((re.escape(name) for name in names if name), key=len, reverse=True)
+        self._mention = re.compile(r'\s*(?:' + '|'.join(names) + r')(?!\w)[\s,:]*', re.IGNORECASE)
+
+    def match(self, text):
+        """
+        Find the command a message text asks for
+
+        :return: (route, args) where args is None for routes registered without an argument pattern, or None if
+                 nothing matches
+        """
+        if self._pattern is None or not text:
+            return None
+        if self._mention is not None:
+            mention = self._mention.match(text)
+            if mention is not None:
+                text = text[mention.end():]
+
+        match = self._pattern.fullmatch(text)
+        if match is None:
+            return None
+        route = self._groups[match.lastgroup if match.lastgroup != 'argtext' else self._matched_group(match)]
+        argtext = match.group('argtext') or ''
+
+        if route.args is None:
+            return (route, None) if not argtext else None
+        args = route.parse_args(argtext)
+        if args is None:
+            return None
+        return route, args
+
+    def _matched_group(self, match):
+        for group, value in match.groupdict().items():
+            if group != 'argtext' and value is not None:
+                return group
+
+    def __iter__(self):
+        return iter(self._routes.values())
+
+
+class BroadcastResult():
+    """
+    Per room outcome of FireBot.broadcast
+    """
+    def __init__(self, room_ids):
+        self.room_ids = list(dict.fromkeys(room_ids))
+        self.sent = {}
+        self.failed = {}
+        self.skipped = []
+
+    @property
+    def remaining(self):
+        """Rooms that did not get the message, pass them to broadcast again to resume"""
+        return [rid for rid in self.room_ids if rid not in self.sent and rid not in self.skipped]
+
+    @property
+    def complete(self):
+        return not self.remaining
+
+    def __repr__(self):
+        return (f'BroadcastResult(sent={len(self.sent)}, failed={len(self.failed)}, skipped={len(self.skipped)}, '
+                f'remaining={len(self.remaining)})')
+
+
+class WebsocketConnection():
+    """
+    The device websocket, kept open across start_bot runs.
+
+    A ping is sent whenever nothing has been received for ping_interval seconds, and the peer is declared dead when
+    nothing, not even a pong, arrived for dead_after seconds. Lost connections are reopened with jittered
+    exponential backoff, reusing the device registration already held by the backend.
+    """
+    def __init__(self, backend, ping_interval=30, dead_after=75, backoff_base=1, backoff_max=60):
+        self._backend = backend
+        self.ping_interval = ping_interval
+        self.dead_after = dead_after
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._ws = None
+        self._last_seen = 0
+        self._down_since = time.monotonic()
+        self._counters = {'connects': 0, 'reconnects': 0, 'failed_connects': 0, 'dead_peers': 0, 'pings': 0}
+        self._downtime = 0.0
+        self._connected_at = None
+
+    def backoff_delay(self, attempt):
+        """
+        Seconds to wait before connection attempt number attempt (0 based): exponential with full jitter
+        """
+        return backoff_delay(attempt, self.backoff_base, self.backoff_max)
+
+    def connect(self):
+        """
+        Open and authorize the websocket, retrying with backoff until it succeeds
+        """
+        attempt = 0
+        while self._ws is None:
+            if attempt:
+                time.sleep(self.backoff_delay(attempt - 1))
+            attempt += 1
+            try:
+                url = self._backend.device_info['webSocketUrl']
+                log.debug(f'Opening websocket connection to {url}')
+                ws = websocket.create_connection(url, timeout=self.ping_interval)
+                ws.send(json.dumps(self._backend._authorization_frame()))
+            except websocket.WebSocketBadStatusException as error:
+                self._counters['failed_connects'] += 1
+                self._backend.metrics.inc('websocket_failed_connects')
+                log.warning(f'Websocket connection refused: {error!r}')
+                if error.status_code in (401, 403, 404, 410):
+                    self._refresh_device()
+                continue
+            except (websocket.WebSocketException, OSError) as error:
+                self._counters['failed_connects'] += 1
+                self._backend.metrics.inc('websocket_failed_connects')
+                log.warning(f'Websocket connection failed: {error!r}')
+                continue
+
+            self._ws = self._backend.wsk = ws
+            now = time.monotonic()
+            self._last_seen = now
+            if self._counters['connects']:
+                self._counters['reconnects'] += 1
+                self._backend.metrics.inc('websocket_reconnects')
+            self._counters['connects'] += 1
+            self._backend.metrics.inc('websocket_connects')
+            self._downtime += now - self._down_since
+            self._connected_at = now
+        return self._ws
+
+    def _refresh_device(self):
+        try:
+            self._backend.refresh_device()
+        except Exception:
+            log.exception('Failed to register the Webex Teams device again')
+
+    def _drop(self):
+        if self._ws is not None:
+            try:
+                self._ws.close()
+            except Exception:
+                pass
+            self._ws = None
+            self._down_since = time.monotonic()
+            self._connected_at = None
+
+    def recv(self):
+        """
+        Return the next data frame, pinging while the line is idle
+
+        :raises websocket.WebSocketException: if the peer is dead or the connection closed
+        """
+        ws = self._ws
+        while True:
+            try:
+                opcode, data = ws.recv_data(control_frame=True)
+            except websocket.WebSocketTimeoutException:
+                if time.monotonic() - self._last_seen > self.dead_after:
+                    self._counters['dead_peers'] += 1
+                    self._backend.metrics.inc('websocket_dead_peers')
+                    raise websocket.WebSocketException(f'No frame received for {self.dead_after}s, peer is dead')
+                ws.ping()
+                self._counters['pings'] += 1
+                continue
+
+            self._last_seen = time.monotonic()
+            if opcode == websocket.ABNF.OPCODE_CLOSE:
+                raise websocket.WebSocketConnectionClosedException('Connection closed by Webex Teams')
+            if opcode in (websocket.ABNF.OPCODE_TEXT, websocket.ABNF.OPCODE_BINARY):
+                return data
+
+    def frames(self):
+        """
+        Yield data frames forever, reconnecting whenever the connection is lost
+        """
+        while True:
+            if self._ws is None:
+                self.connect()
+            try:
+                data = self.recv()
+            except (websocket.WebSocketException, OSError) as error:
+                log.warning(f'Websocket connection lost: {error!r}')
+                self._drop()
+                continue
+            yield data
+
+    def close(self):
+        self._drop()
+
+    @property
+    def connected(self):
+        return self._ws is not None
+
+    def stats(self):
+        """
+        Connection counters, total seconds spent disconnected and the current connection's uptime
+        """
+        now = time.monotonic()
+        stats = dict(self._counters)
+        stats['downtime'] = self._downtime + (0 if self._ws is not None else now - self._down_since)
+        stats['uptime'] = now - self._connected_at if self._connected_at is not None else 0.0
+        return stats
+
+
+class DedupWindow():
+    """
+    Remembers the activity ids seen in the last window seconds to drop activities delivered more than once, e.g.
+    after a reconnect or through several devices.
+
+    Ids are kept in one set per window / buckets seconds and whole buckets are expired at once. When more than
+    max_entries ids are held, the oldest buckets are dropped early.
+    """
+    def __init__(self, window=600, buckets=10, max_entries=100000):
+        self.bucket_span = window / buckets
+        self.buckets = buckets
+        self.max_entries = max_entries
+        self._buckets = deque()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    def seen(self, activity_id):
+        """
+        Record an activity id, returning True if it was already seen within the window
+        """
+        now = time.monotonic()
+        with self._lock:
+            while self._buckets and (now - self._buckets[0][0] > self.bucket_span * self.buckets or
+                                     self._size > self.max_entries):
+                self._size -= len(self._buckets.popleft()[1])
+
+            for _, ids in self._buckets:
+                if activity_id in ids:
+                    self.suppressed += 1
+                    return True
+
+            if not self._buckets or now - self._buckets[-1][0] >= self.bucket_span:
+                self._buckets.append((now, set()))
+            self._buckets[-1][1].add(activity_id)
+            self._size += 1
+            return False
+
+    def stats(self):
+        return {'tracked': self._size, 'suppressed': self.suppressed}
+
+
+class ActivityFilter():
+    """
+    Decides from the metadata of a post activity alone whether the message it announces needs to be fetched.
+
+    A message is skipped when it was posted by the bot, when its room is not one of the subscribed rooms, or when
+    it was posted in a group room without mentioning the bot (or everyone) and require_mention is set. Activities
+    lacking the metadata needed for a decision are always fetched. Websocket activities carry the actor, mentions
+    and ONE_ON_ONE room tag; webhook activities carry the webhook's personId, mentionedPeople and roomType.
+
+    :param require_mention: Skip group room messages that do not mention the bot
+    :param rooms: Only fetch messages of these rooms, None for every room
+    """
+    def __init__(self, require_mention=True, rooms=None):
+        self.require_mention = require_mention
+        self.rooms = None if rooms is None else {webex_uuid(room_id) for room_id in rooms}
+        self._bot_id = None
+        self._counters = {'checked': 0, 'avoided_fetches': 0, 'from_self': 0, 'unsubscribed': 0,
+                          'not_mentioned': 0}
+
+    def set_bot(self, person_id):
+        self._bot_id = webex_uuid(person_id)
+
+    def subscribe(self, room_id):
+        """
+        Fetch the messages of room_id; the first subscription restricts fetching to the subscribed rooms
+        """
+        if self.rooms is None:
+            self.rooms = set()
+        self.rooms.add(webex_uuid(room_id))
+
+    def unsubscribe(self, room_id):
+        if self.rooms is not None:
+            self.rooms.discard(webex_uuid(room_id))
+
+    def _metadata(self, activity):
+        """
+        (actor id, room id, direct room or None if unknown, mentioned ids, everyone mentioned)
+        """
+        webhook = activity.get('webhook')
+        if webhook is not None:
+            data = webhook['data']
+            room_type = data.get('roomType')
+            return (webex_uuid(data.get('personId')), webex_uuid(data.get('roomId')),
+                    None if room_type is None else room_type == 'direct',
+                    {webex_uuid(person_id) for person_id in data.get('mentionedPeople', ())},
+                    'all' in data.get('mentionedGroups', ()))
+
+        target = activity.get('target') or {}
+        obj = activity.get('object') or {}
+        tags = target.get('tags')
+        mentions = {item.get('id') for item in (obj.get('mentions') or {}).get('items', ())}
+        everyone = any(item.get('groupType') == 'all' for item in (obj.get('groupMentions') or {}).get('items', ()))
+        return ((activity.get('actor') or {}).get('id'), target.get('id'),
+                None if tags is None else 'ONE_ON_ONE' in tags, mentions, everyone)
+
+    def wants(self, activity):
+        """
+        False when the message of a post activity can be ignored without fetching it
+        """
+        self._counters['checked'] += 1
+        actor, room_id, direct, mentions, everyone = self._metadata(activity)
+        if self._bot_id is not None and actor == self._bot_id:
+            reason = 'from_self'
+        elif self.rooms is not None and room_id is not None and room_id not in self.rooms:
+            reason = 'unsubscribed'
+        elif (self.require_mention and direct is False and self._bot_id is not None and
+              self._bot_id not in mentions and not everyone):
+            reason = 'not_mentioned'
         else:
-            return self.commands["help"][0](msg)
+            return True
+        self._counters[reason] += 1
+        self._counters['avoided_fetches'] += 1
+        return False
+
+    def stats(self):
+        return dict(self._counters)
+
+
+class FireBot():
+
+    token=""
+    bot = None
+    busy_text = "I'm busy right now, please try again in a moment."
+    def __init__(self, token, workers=8, max_queue=256, overload=DISPATCH_BLOCK, processes=0, pipeline=False,
+                 fetchers=4, ping_interval=30, dead_after=75, list_rooms=False, dispatcher=None,
+                 backend_options=None, work_queue=None, dedup_window=600, metrics=None, metrics_port=None,
+                 logging_options=None, require_mention=True, rooms=None):
+        """
+        :param token: The Webex Teams bot token
+        :param workers: Number of threads running command handlers
+        :param max_queue: Number of matched commands that may wait for a free worker
+        :param overload: What to do when the queue is full, one of DISPATCH_BLOCK, DISPATCH_DROP or DISPATCH_REJECT
+        :param processes: Size of the process pool used by commands added with process=True
+        :param pipeline: Only receive and parse frames on the websocket thread and fetch the messages they refer to
+                         on separate threads, keeping the order of activities within each room
+        :param fetchers: Number of fetch threads used in pipeline mode
+        :param ping_interval: Seconds of silence on the websocket before it is pinged
+        :param dead_after: Seconds of silence after which the websocket is considered dead and reopened
+        :param list_rooms: Log the rooms the bot is in at start, from a background thread
+        :param dispatcher: A CommandDispatcher shared with other bots, instead of one of its own
+        :param backend_options: Keyword arguments for CiscoWebexTeamsBackend
+        :param work_queue: Publish activities to this WorkQueue for a WorkerPool instead of handling them here
+        :param dedup_window: Seconds during which an activity delivered again is dropped before any REST call
+        :param metrics: A Metrics shared with other bots, instead of one of its own
+        :param metrics_port: Serve the metrics at http://127.0.0.1:<metrics_port>/metrics once started
+        :param logging_options: Keyword arguments for configure_logging, e.g. levels, sample or trace
+        :param require_mention: Ignore, without fetching them, group room messages that do not mention the bot
+        :param rooms: Only fetch and handle the messages of these rooms, see ActivityFilter
+        """
+        self.token = token
+        self.logging_options = logging_options or {}
+        self.metrics = metrics or Metrics()
+        self.metrics_port = metrics_port
+        self.commands = {}
+        self.backend_options = backend_options or {}
+        self.work_queue = work_queue
+        self.dedup = DedupWindow(window=dedup_window)
+        self.filter = ActivityFilter(require_mention=require_mention, rooms=rooms)
+        self._counters = {'activities': 0, 'commands': 0}
+        self.dispatcher = dispatcher or CommandDispatcher(workers=workers, max_queue=max_queue, policy=overload,
+                                                          processes=processes, on_reject=self._reject)
+        self.lanes = ActivityLanes(self.handle_activity, lanes=fetchers, max_queue=max_queue) if pipeline else None
+        self.fetchers = fetchers
+        self.metrics.gauge('dispatcher_queue_depth', lambda: self.dispatcher.stats()['queue_depth'])
+        self.metrics.gauge('dispatcher_in_flight', lambda: self.dispatcher.stats()['in_flight'])
+        if self.lanes is not None:
+            self.metrics.gauge('lanes_queue_depth', lambda: self.lanes.queue_depth)
+        self.max_concurrency = max_queue
+        self.max_queue = max_queue
+        self.ping_interval = ping_interval
+        self.dead_after = dead_after
+        self.connection = None
+        self.api = None
+        self.list_rooms = list_rooms
+        self._started_at = None
+        self._first_message_at = None
+        self.router = CommandRouter()
+        self.cards = CardTemplates()
+        self.add_command("help", self.helpme, "List all commands")
+
+    def _reject(self, roomId):
+        self.send_message(roomId, self.busy_text, wait=False)
+
+    def helpme(self, *argv):
+        msg = argv[0]
+        helpdoc = "Here are the available commands :\n"
+        for cmd,helper in self.commands.items():
+            if cmd!="cardaction":
+                helpdoc+='{} : {}'.format(cmd, helper[1])+"\n"
+        self.send_message(msg.roomId, helpdoc)
+
+    def add_command(self, command, func, helper=None, process=False, aliases=(), args=None):
+        """
+        Register a command handler
+
+        :param command: The command text, matched case insensitively
+        :param func: The handler, or the name of one
+        :param helper: Help text listed by the help command
+        :param process: Run the handler in the dispatcher process pool rather than a worker thread
+        :param aliases: Other texts that run the same command
+        :param args: Accept text after the command: True to get the whitespace separated words, or a regex the text
+                     must fully match to get its groups. The parsed arguments are passed to the handler as a third
+                     argument, after the message and the activity. Commands added without args only match when
+                     nothing follows them.
+
+        func may be a coroutine function. Under start_async it runs on the bot's event loop, otherwise each call
+        runs to completion on a dispatcher worker.
+        """
+        if command is None or func is None:
+            return 0
+        else:
+            if isinstance(func, str):
+                func = eval(func)
+            self.commands[command.lower()]=[func, helper, process]
+            if command.lower() != "cardaction":
+                self.router.add(CommandRoute(command.lower(), func, helper, process, aliases, args))
+            commands_log.debug('Command added', extra={'fields': {'command': command.lower(),
+                                                                  'aliases': list(aliases), 'process': process}})
+
+    def process_command(self, txt, msg):
+        if txt in self.commands:
+            return self.commands[txt][0]
+        return None
 
     def process_card_action(self):
         return self.commands["cardaction"][0]
 
+    def _backend_options(self, **options):
+        options = dict(self.backend_options, **options)
+        options.setdefault('metrics', self.metrics)
+        # Handlers and fetch lanes call the REST API concurrently with the backend's own workers
+        options.setdefault('concurrency', self.dispatcher.workers + (self.fetchers if self.lanes is not None else 0))
+        return options
+
+    def _command_done(self, command):
+        """
+        The on_done callback recording a handler's latency and outcome for the command
+        """
+        def done(seconds, error):
+            self.metrics.observe('handler', seconds, error, command=command)
+            self.metrics.inc('commands', command=command)
+            if error is not None:
+                self.metrics.inc('command_errors', command=command)
+        return done
+
+    def dispatcher_stats(self):
+        """
+        Queue depth, in flight and outcome counters of the command dispatcher
+        """
+        return self.dispatcher.stats()
+
     def start_bot(self):
         """
         Signal that we are connected to the Webex Teams Service.
@@ -815,111 +3444,1073 @@ class FireBot():
         """
         try:
             bot = self.bot
-            print(bot.bot_identifier.displayName)
-            url = bot.device_info['webSocketUrl']
-            print("Opening websocket connection to %s" % websocket)
-            websocket.enableTrace(True)
-            print("Creating Connection")
-            wsk = websocket.create_connection(url)
-            print(wsk)
-            bot.wsk=wsk
-            print('Connection Created')
-            bot.wsk.on_open = bot.on_open
-            msg = {'id': str(uuid.uuid4()),
-                   'type': 'authorization',
-                   'data': {
-                            'token': 'Bearer ' + bot._bot_token
-                           }
-                  }
-            bot.wsk.send(json.dumps(msg))
-        
-            while True:
-                in_data = bot.wsk.recv()
-                message = json.loads(in_data.decode('utf-8'))
-                if message['data']['eventType'] != 'conversation.activity':
-                    print('Ignoring msg where Event Type is not conversation.activity')
-                    continue 
-                print(message) 
-                activity = message['data']['activity']
-                #print(activity)
-                if activity['verb'] == 'cardAction':
-                    msg = bot.webex_teams_api.attachment_actions.get(activity['id'])
-                    pmsg =bot.webex_teams_api.messages.get(activity['parent']['id']) 
-                    cmd = self.process_card_action()
-                    x=threading.Thread(target=cmd, args=(msg,pmsg,activity,))
-                    x.start()
-                    continue
-                if activity['verb'] != 'post':
-                    print('Ignoring message where the verb is not type "post"')
-                    continue 
-                teams_msg = bot.webex_teams_api.messages.get(activity['id'])
-                if teams_msg.personEmail in bot.bot_identifier.emails:
-                    print('Ignoring message from myself')
-                    continue 
-                txt = teams_msg.text
-                botName = bot.bot_identifier.displayName
-                print('Message from %s: %s\n' % (teams_msg.personEmail,txt))
-                if txt.find(botName) != -1:
-                    txt = (txt[len(botName):]).strip()
-                elif txt.find(botName.split(" ")[0]) != -1:
-                    txt = (txt[len(botName.split(" ")[0]):]).strip()
-                txt = ((txt.lower()).replace(" ", "")).strip()
-                if txt in self.commands:
-                    print("CMD FOUND")
-                    command = self.process_command(txt, teams_msg)
-                    print(command)
-                    x=threading.Thread(target=command, args=(teams_msg,activity))
-                    x.start()
+            connection_log.info('Receiving activities', extra={'fields': {'bot': bot.bot_identifier.displayName}})
+            for in_data in self.connection.frames():
+                # Timed from the arrival of the frame until the loop is ready for the next one, not the idle wait
+                with self.metrics.stage('recv'):
+                    self._receive(in_data)
         except KeyboardInterrupt:
-            print("Interrupt received, shutting down..")
-            bot.wsk.shutdown()
+            log.info('Interrupt received, shutting down')
+            self.connection.close()
+            return True
+
+    def _receive(self, in_data):
+        """
+        Parse a websocket frame and hand its activity on, or handle it right away when there is no pipeline
+        """
+        with self.metrics.stage('parse'):
+            activity = self.bot.decoder.activity(in_data)
+        if activity is None:
+            frames_log.debug('Ignoring event that is not a conversation activity')
+            return
+        frames_log.debug('Activity received', extra={'fields': {'id': activity['id'], 'verb': activity['verb']}})
+        if self.dedup.seen(activity['id']):
+            return
+        if self.work_queue is not None:
+            self.work_queue.put(activity_room_key(activity), activity)
+        elif self.lanes is not None:
+            self.lanes.submit(activity_room_key(activity), activity)
+        else:
+            self.handle_activity(activity)
+
+    def handle_activity(self, activity):
+        """
+        Fetch the message or card action a websocket activity refers to and dispatch it to its command handler
+        """
+        bot = self.bot
+        self._counters['activities'] += 1
+        self.metrics.inc('activities', verb=activity['verb'])
+        bot.handle_room_event(activity)
+        if activity['verb'] == 'cardAction':
+            if "cardaction" not in self.commands:
+                frames_log.debug('Ignoring card action, no cardaction command', extra={'fields': {'id': activity['id']}})
+                return
+            with self.metrics.stage('hydrate'):
+                msg = bot.get_light('attachment/actions', activity['id'], webexteamssdk.AttachmentAction)
+                pmsg = bot.get_light('messages', activity['parent']['id'], webexteamssdk.Message)
+            cmd = self.process_card_action()
+            self.dispatcher.submit(cmd, (msg, pmsg, activity), reply_to=msg.roomId,
+                                   process=self.commands["cardaction"][2], on_reject=self._reject,
+                                   on_done=self._command_done('cardaction'), key=activity_room_key(activity))
+            return
+        if activity['verb'] != 'post':
+            frames_log.debug('Ignoring activity', extra={'fields': {'id': activity['id'], 'verb': activity['verb']}})
+            return 
+        if not self._wants(activity):
+            return
+        with self.metrics.stage('hydrate'):
+            teams_msg = bot.get_light('messages', activity['id'], webexteamssdk.Message)
+        with self.metrics.stage('route'):
+            matched = self.match_command(teams_msg)
+        if matched is not None:
+            route, args = matched
+            self._counters['commands'] += 1
+            if self._first_message_at is None:
+                self._first_message_at = time.monotonic()
+            self.dispatcher.submit(route.func, self._handler_args(route, teams_msg, activity, args),
+                                   reply_to=teams_msg.roomId, process=route.process, on_reject=self._reject,
+                                   on_done=self._command_done(route.name), key=activity_room_key(activity))
+
+    def _wants(self, activity):
+        """
+        Run the activity filter, counting the fetches it avoids
+        """
+        if self.filter.wants(activity):
             return True
+        self.metrics.inc('avoided_fetches')
+        frames_log.debug('Ignoring message without fetching it', extra={'fields': {'id': activity['id']}})
+        return False
+
+    def match_command(self, teams_msg):
+        """
+        Return the (route, args) a message asks for, or None
+        """
+        bot = self.bot
+        if teams_msg.personEmail in bot.bot_identifier.emails:
+            messages_log.debug('Ignoring message from myself', extra={'fields': {'id': teams_msg.id}})
+            return None
+        messages_log.debug('Message received', extra={'fields': {'id': teams_msg.id, 'roomId': teams_msg.roomId}})
+        matched = self.router.match(teams_msg.text)
+        if matched is not None:
+            commands_log.debug('Command matched', extra={'fields': {'id': teams_msg.id,
+                                                                    'command': matched[0].name}})
+        return matched
+
+    @staticmethod
+    def _handler_args(route, teams_msg, activity, args):
+        if route.args is None:
+            return (teams_msg, activity)
+        return (teams_msg, activity, args)
+
+    def start_async(self):
+        """
+        Run the bot on an asyncio event loop in the calling thread
+        """
+        configure_logging(**self.logging_options)
+        self._started_at = time.monotonic()
+        asyncio.run(self.run_async())
+
+    async def run_async(self, session=None):
+        """
+        Serve the device websocket with asyncio, reconnecting with backoff whenever the connection drops.
+
+        Activities are handled as tasks, at most max_concurrency at a time and one at a time per room, and REST lookups
+        go through AsyncWebexTeamsAPI so no thread is tied up per message.
+
+        :param session: aiohttp.ClientSession shared with other bots
+        """
+        loop = asyncio.get_running_loop()
+        await self._setup_with_retry(session)
+        self._failures = 0
+        self._connects = 0
+        try:
+            while True:
+                connects = self._connects
+                try:
+                    await self._serve_async()
+                except Exception as e:
+                    connection_log.warning(f'{e!r}; reconnecting')
+                    if self._connects == connects:
+                        self.metrics.inc('websocket_failed_connects')
+                    if handshake_status(e) in (401, 403, 404, 410):
+                        await loop.run_in_executor(None, self.bot.refresh_device)
+                await asyncio.sleep(backoff_delay(self._failures))
+                self._failures += 1
+        finally:
+            await self.api.close()
+
+    async def _setup_with_retry(self, session=None, **backend_options):
+        """
+        Run _setup_async until it succeeds, backing off between attempts. A bot whose token or device cannot be set
+        up right now keeps trying without affecting the other bots sharing the event loop
+        """
+        attempt = 0
+        while True:
+            try:
+                return await self._setup_async(session, **backend_options)
+            except Exception:
+                log.exception('Failed to set up the bot, retrying')
+                await asyncio.sleep(backoff_delay(attempt))
+                attempt += 1
+
+    async def _setup_async(self, session=None, **backend_options):
+        """
+        Create the backend and the asyncio state shared by the websocket and webhook runtimes
+        """
+        loop = asyncio.get_running_loop()
+        if self.bot is None:
+            options = self._backend_options(**backend_options)
+            self.bot = await loop.run_in_executor(None, functools.partial(CiscoWebexTeamsBackend, self.token,
+                                                                          **options))
+        self.router.set_mention(self.bot.bot_identifier.displayName)
+        self.filter.set_bot(self.bot.bot_identifier.id)
+        self.api = AsyncWebexTeamsAPI(self.token, session=session, metrics=self.metrics)
+        if self.metrics_port is not None and self.metrics._server is None:
+            self.metrics.serve(self.metrics_port)
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self._backlog = asyncio.Semaphore(self.max_concurrency + self.max_queue)
+        self._room_locks = {}
+        self._tasks = set()
+
+    async def submit_activity(self, activity):
+        """
+        Handle an activity as a task, waiting while max_concurrency activities are being handled and max_queue more
+        wait for their room
+        """
+        await self._backlog.acquire()
+        task = asyncio.create_task(self._run_in_room(activity))
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    async def _serve_async(self):
+        url = self.bot.device_info['webSocketUrl']
+        async with websockets.connect(url) as wsk:
+            await wsk.send(json.dumps(self.bot._authorization_frame()))
+            self._failures = 0
+            if self._connects:
+                self.metrics.inc('websocket_reconnects')
+            self._connects += 1
+            self.metrics.inc('websocket_connects')
+            while True:
+                in_data = await wsk.recv()
+                # As in start_bot, timed from the arrival of the frame rather than from the wait for it
+                with self.metrics.stage('recv'):
+                    await self._receive_async(in_data)
+
+    async def _receive_async(self, in_data):
+        with self.metrics.stage('parse'):
+            activity = self.bot.decoder.activity(in_data)
+        if activity is None:
+            return
+        if self.dedup.seen(activity['id']):
+            return
+        if self.work_queue is not None:
+            self.work_queue.put(activity_room_key(activity), activity)
+            return
+        await self.submit_activity(activity)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        self._backlog.release()
+
+    async def _run_in_room(self, activity):
+        """
+        Handle an activity once every earlier activity of the same room has been handled. The room comes first and
+        the concurrency slot second, so activities queued behind a busy room never hold slots other rooms could use
+        """
+        key = activity_room_key(activity)
+        entry = self._room_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await self.handle_activity_async(activity)
+        except Exception:
+            log.exception(f'Failed to handle activity {activity["id"]}')
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._room_locks[key]
+
+    async def handle_activity_async(self, activity):
+        """
+        Asynchronous counterpart of handle_activity
+        """
+        self._counters['activities'] += 1
+        self.metrics.inc('activities', verb=activity['verb'])
+        self.bot.handle_room_event(activity)
+        if activity['verb'] == 'cardAction':
+            if "cardaction" not in self.commands:
+                return
+            with self.metrics.stage('hydrate'):
+                msg, pmsg = await asyncio.gather(self.api.attachment_actions.get_light(activity['id']),
+                                                 self.api.messages.get_light(activity['parent']['id']))
+            await self._call_handler(self.process_card_action(), (msg, pmsg, activity), msg.roomId,
+                                     self.commands["cardaction"][2], 'cardaction', activity_room_key(activity))
+            return
+        if activity['verb'] != 'post' or not self._wants(activity):
+            return
+        with self.metrics.stage('hydrate'):
+            teams_msg = await self.api.messages.get_light(activity['id'])
+        with self.metrics.stage('route'):
+            matched = self.match_command(teams_msg)
+        if matched is not None:
+            route, args = matched
+            self._counters['commands'] += 1
+            if self._first_message_at is None:
+                self._first_message_at = time.monotonic()
+            await self._call_handler(route.func, self._handler_args(route, teams_msg, activity, args),
+                                     teams_msg.roomId, route.process, route.name, activity_room_key(activity))
+
+    async def _call_handler(self, func, args, roomId, process, command=None, key=None):
+        """
+        Run a handler and return once it finished, so the room lock held by the caller covers the whole handler
+        """
+        done = self._command_done(command)
+        if asyncio.iscoroutinefunction(func):
+            error = None
+            started = time.perf_counter()
+            try:
+                await func(*args)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                done(time.perf_counter() - started, error)
+        else:
+            loop = asyncio.get_running_loop()
+            finished = loop.create_future()
+
+            def on_done(seconds, error):
+                try:
+                    done(seconds, error)
+                finally:
+                    loop.call_soon_threadsafe(finished.set_result, None)
+
+            queued = await loop.run_in_executor(None, functools.partial(self.dispatcher.submit, func, args, roomId,
+                                                                        process, self._reject, on_done, key))
+            if queued:
+                await finished
 
     def get_using_id(self, pid):
         """
         Return a Cisco Webex Teams person when searching using an ID
         """
         try:
-            print(pid)
-            self.webex_teams_api.people.get(pid)
+            person = self.bot.person_cache.by_id(pid)
         except:
-          raise FailedToFindWebexTeamsPerson(f'Could not find the user using the id {pid}')
+            person = None
+        if person is None:
+            raise FailedToFindWebexTeamsPerson(f'Could not find the user using the id {pid}')
+        return person
     def delete_message(self, mid):
         self.bot.webex_teams_api.messages.delete(mid)
 
-    def send_message(self, roomId, mess, parent=None):
+    def _send(self, payload, wait):
+        future = self.bot.outbox.submit(payload)
+        return future.result() if wait else future
+
+    def send_message(self, roomId, mess, parent=None, wait=True):
         """
         Send a message to Cisco Webex Teams
 
         :param mess: A CiscoWebexTeamsMessage
+        :param wait: Wait for the message to be sent and return it. Otherwise return a Future right away
+        """
+        payload = {'roomId': roomId, 'text': mess}
+        if parent is not None:
+            payload['parentId'] = parent
+        return self._send(payload, wait)
+
+    async def send_message_async(self, roomId, mess, parent=None):
+        """
+        Send a message to Cisco Webex Teams from a coroutine handler running under start_async
+
+        The message goes through the outbox like every other send, so it is subject to the same rate limiting.
+        """
+        payload = {'roomId': roomId, 'text': mess}
+        if parent is not None:
+            payload['parentId'] = parent
+        return await asyncio.wrap_future(self.bot.outbox.submit(payload))
+
+    def send_file(self, rid, filen, filel, wait=True, text=None, progress=None):
         """
- #       if parent is not None:
-        return self.bot.webex_teams_api.messages.create(roomId=roomId, text=mess, parentId=parent)
-#        else:
- #           return self.bot.webex_teams_api.messages.create(roomId=roomid, text=mess)#, markdown=md)
+        Upload a file to a room without loading it in memory
 
-    def send_file(self, rid, filen, filel):
-        self.bot.webex_teams_api.messages.create(roomId=rid, files=[filel,])
+        :param filen: File name shown in Webex Teams, defaults to the name of filel
+        :param filel: A path, a file object or an iterable of bytes
+        :param wait: Wait for the upload to finish and return the message. Otherwise return a Future right away
+        :param progress: Optional callable called with (bytes sent, total size or None)
+        :raises FileTooLarge: when the file is known to exceed the Webex Teams limit
+        """
+        future = self.bot.uploads.upload({'roomId': rid, 'text': text}, filel, filename=filen, progress=progress)
+        return future.result() if wait else future
 
-    def send_message_with_attachment(self, rid, msgtxt, attachment):
+    def send_message_with_attachment(self, rid, msgtxt, attachment, wait=True):
         if isinstance(attachment, str):
-            attachment=json.loads(attachment)
+            attachment=self.bot.renderer.card(attachment)
         alist = [attachment]
-        return(self.bot.webex_teams_api.messages.create(roomId=rid, markdown=msgtxt, attachments=alist))
+        return self._send({'roomId': rid, 'markdown': msgtxt, 'attachments': alist}, wait)
+
+    def add_card(self, name, source):
+        """
+        Register a card template, see CardTemplates.register
+        """
+        self.cards.register(name, source)
+
+    def send_card(self, rid, card, msgtxt, values=None, wait=True):
+        """
+        Send a card registered with add_card
+
+        :param values: dict replacing the ${key} placeholders of the card
+        """
+        return self.send_message_with_attachment(rid, msgtxt, self.cards.render(card, **(values or {})), wait=wait)
+
+    def broadcast(self, room_ids, text=None, card=None, markdown=None, parallelism=50, state_file=None):
+        """
+        Send the same message to many rooms
+
+        The payload is built once and the sends are queued on the outbox, at most parallelism at a time, so they are
+        spread over its workers while respecting the rate limits.
+
+        :param room_ids: Rooms to send to
+        :param text: Plain text of the message
+        :param card: Adaptive card attachment, as a dict or a JSON string
+        :param markdown: Markdown of the message
+        :param parallelism: Maximum number of sends queued or in flight at once
+        :param state_file: File recording the rooms already sent to. Rooms listed in it are skipped, so running the
+                           same broadcast again after a failure or a restart only sends to the remaining rooms
+        :return: BroadcastResult
+        """
+        payload = {}
+        if text is not None:
+            payload['text'] = text
+        if markdown is not None:
+            payload['markdown'] = markdown
+        if card is not None:
+            payload['attachments'] = [self.bot.renderer.card(card) if isinstance(card, str) else card]
+        if not payload:
+            raise ValueError("broadcast needs text, markdown or a card")
+
+        result = BroadcastResult(room_ids)
+        done = set()
+        if state_file is not None and os.path.exists(state_file):
+            with open(state_file) as f:
+                done = {json.loads(line)['roomId'] for line in f if line.strip()}
+
+        state = open(state_file, 'a') if state_file is not None else None
+        lock = threading.Lock()
+        slots = threading.BoundedSemaphore(parallelism)
+
+        def finished(future, rid):
+            try:
+                message = future.result()
+            except Exception as error:
+                with lock:
+                    result.failed[rid] = error
+            else:
+                with lock:
+                    result.sent[rid] = message.id
+                    if state is not None:
+                        state.write(json.dumps({'roomId': rid, 'id': message.id}) + "\n")
+                        state.flush()
+            finally:
+                slots.release()
+
+        try:
+            for rid in result.room_ids:
+                if rid in done:
+                    result.skipped.append(rid)
+                    continue
+                slots.acquire()
+                future = self.bot.outbox.submit(dict(payload, roomId=rid))
+                future.add_done_callback(lambda f, rid=rid: finished(f, rid))
+            # Wait for the sends still in flight
+            for _ in range(parallelism):
+                slots.acquire()
+        finally:
+            if state is not None:
+                state.close()
+
+        log.info(f'Broadcast to {len(result.room_ids)} rooms finished: {result!r}')
+        return result
+
+    def outbox_stats(self):
+        """
+        Queue depth, send counters and queue latency of the outbound message queue
+        """
+        return self.bot.outbox.stats()
 
     def botwrap(self):
-        print('botwrap')
+        failures = 0
         while True:
+            started = time.monotonic()
             try:
                self.start_bot()
             except BaseException as e:
-               print('{!r}; restarting thread'.format(e))
+               connection_log.warning(f'{e!r}; restarting the websocket loop')
+               if time.monotonic() - started > self.connection.backoff_max:
+                   failures = 0
+               # The connection survives start_bot failures, back off so a persistent error does not spin
+               time.sleep(self.connection.backoff_delay(failures))
+               failures += 1
             else:
-               print('exited normally, bad thread; restarting')
+               connection_log.warning('Websocket loop exited; restarting')
+
+    def connection_stats(self):
+        """
+        Reconnect counters and downtime of the device websocket
+        """
+        return self.connection.stats()
+
+    def stats(self):
+        """
+        Everything this bot measures, in one dict
+        """
+        stats = {'counters': dict(self._counters), 'dispatcher': self.dispatcher.stats(),
+                 'startup': self.startup_stats(), 'dedup': self.dedup.stats(), 'filter': self.filter.stats(),
+                 'metrics': self.metrics.snapshot(),
+                 'logging': logging_stats()}
+        if self.bot is not None:
+            stats['outbox'] = self.bot.outbox.stats()
+            stats['caches'] = self.bot.cache_stats()
+            stats['decoder'] = self.bot.decoder.stats()
+            stats['http'] = self.bot.http_stats()
+        if self.connection is not None:
+            stats['connection'] = self.connection.stats()
+        return stats
+
+    def startup_stats(self):
+        """
+        Seconds spent in each bootstrap call, and from start until the backend was ready and until the first
+        command was dispatched
+        """
+        stats = dict(self.bot.startup_timings) if self.bot is not None else {}
+        if self._started_at is not None and self._first_message_at is not None:
+            stats['first_message'] = self._first_message_at - self._started_at
+        return stats
+
+    def _print_rooms(self):
+        log.info('Rooms', extra={'fields': {'rooms': self.bot.rooms()}})
 
     def start(self):
-        bot = CiscoWebexTeamsBackend(self.token)
-        print(bot.rooms())
+        configure_logging(**self.logging_options)
+        self._started_at = time.monotonic()
+        if self.metrics_port is not None:
+            self.metrics.serve(self.metrics_port)
+        bot = CiscoWebexTeamsBackend(self.token, **self._backend_options())
         self.bot=bot
+        if self.list_rooms:
+            threading.Thread(target=self._print_rooms, daemon=True).start()
+        self.router.set_mention(bot.bot_identifier.displayName)
+        self.filter.set_bot(bot.bot_identifier.id)
+        self.connection = WebsocketConnection(bot, ping_interval=self.ping_interval, dead_after=self.dead_after)
         x=threading.Thread(target=self.botwrap, args=())
         x.start()
+
+
+class BotHost():
+    """
+    Runs many bots, one per token, in a single process.
+
+    All bots share one asyncio event loop, one HTTP connection pool for both the aiohttp and the requests based
+    clients, the markdown renderer and the dispatcher running synchronous handlers. Each bot keeps its own command
+    registry, device, websocket, rooms, person cache and outbox, as what a bot can see depends on its token.
+    """
+    def __init__(self, workers=16, max_queue=1024, overload=DISPATCH_BLOCK, processes=0, pool_size=100,
+                 person_cache_size=16384, person_cache_ttl=3600, http2=False):
+        self.bots = []
+        self.dispatcher = CommandDispatcher(workers=workers, max_queue=max_queue, policy=overload,
+                                            processes=processes)
+        self.person_cache_size = person_cache_size
+        self.person_cache_ttl = person_cache_ttl
+        self.renderer = Renderer(rendering.md)
+        self.http_adapter = make_http_adapter(pool_size, http2)
+        self.pool_size = pool_size
+
+    def add_bot(self, token, setup=None, **options):
+        """
+        Add a bot to the host
+
+        :param token: The Webex Teams bot token
+        :param setup: Called with the new FireBot to register its commands
+        :param options: Keyword arguments for FireBot; backend_options are merged with the shared objects
+        :return: FireBot
+        """
+        backend_options = dict(options.pop('backend_options', None) or {})
+        backend_options.setdefault('person_cache_size', self.person_cache_size)
+        backend_options.setdefault('person_cache_ttl', self.person_cache_ttl)
+        backend_options.update(renderer=self.renderer, http_adapter=self.http_adapter)
+        bot = FireBot(token, dispatcher=self.dispatcher, backend_options=backend_options, **options)
+        if setup is not None:
+            setup(bot)
+        self.bots.append(bot)
+        return bot
+
+    def run(self):
+        """
+        Run every bot until interrupted
+        """
+        configure_logging()
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        import aiohttp
+
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size)) as session:
+            for bot in self.bots:
+                bot._started_at = time.monotonic()
+            await asyncio.gather(*(self._supervise(bot, session) for bot in self.bots), return_exceptions=True)
+
+    async def _supervise(self, bot, session):
+        """
+        Run one bot, restarting it with backoff if it fails, so one tenant can never stop the others
+        """
+        failures = 0
+        while True:
+            try:
+                await bot.run_async(session=session)
+            except Exception:
+                log.exception(f'Bot {bot.bot.bot_identifier.email if bot.bot is not None else bot} failed, restarting')
+            await asyncio.sleep(backoff_delay(failures))
+            failures += 1
+
+    def stats(self):
+        """
+        Per bot metrics, keyed by the bot's email once it is connected, plus the shared objects
+        """
+        stats = {'dispatcher': self.dispatcher.stats(), 'renderer': self.renderer.stats(), 'bots': {}}
+        for i, bot in enumerate(self.bots):
+            name = bot.bot.bot_identifier.email if bot.bot is not None else f'bot-{i}'
+            stats['bots'][name] = bot.stats()
+        return stats
+
+
+class WorkQueue(abc.ABC):
+    """
+    Carries activities from the process owning the websocket to WorkerPool processes.
+
+    Activities are spread over a fixed number of partitions by room, and each partition is consumed by a single
+    worker which gets the next activity of a partition only once the previous one was acknowledged. This keeps every
+    room in order. Delivery is at least once: an activity that is not acknowledged is delivered again.
+    """
+    partitions = 1
+
+    def partition(self, key):
+        # crc32 rather than hash() which differs between processes
+        return zlib.crc32(key.encode('utf-8')) % self.partitions
+
+    @abc.abstractmethod
+    def put(self, key, item):
+        pass
+
+    @abc.abstractmethod
+    def get(self, partition, timeout=1.0):
+        """
+        :return: (receipt, item), or None if nothing arrived within timeout
+        """
+
+    @abc.abstractmethod
+    def ack(self, receipt):
+        pass
+
+    def dead_letter(self, receipt, item, error):
+        """
+        Give up on an activity that could not be handled, so the rest of its partition can proceed
+        """
+        log.error(f'Dropping activity {item.get("id")} after {error!r}')
+        self.ack(receipt)
+
+    def reset_partition(self, partition):
+        """
+        Called by WorkerPool, in the publishing process, when the worker of a partition died
+        """
+        pass
+
+
+class MultiprocessingWorkQueue(WorkQueue):
+    """
+    In memory WorkQueue built on multiprocessing queues, for workers started by a WorkerPool in the same process
+    that publishes.
+
+    The publishing process remembers every activity until it is acknowledged. When a worker dies, its partition is
+    rebuilt from those, in order, before a replacement worker is started. get hands out the last activity of a
+    partition again until it is acknowledged.
+    """
+    def __init__(self, partitions=4):
+        self.partitions = partitions
+        self._queues = [_process_context.Queue() for _ in range(partitions)]
+        self._acks = _process_context.Queue()
+        self._pending = {}
+        self._delivered = {}
+        self._receipt = 0
+        self._lock = threading.Lock()
+        threading.Thread(target=self._drain_acks, name="firebot-work-acks", daemon=True).start()
+
+    def put(self, key, item):
+        partition = self.partition(key)
+        with self._lock:
+            self._receipt += 1
+            receipt = (partition, self._receipt)
+            self._pending[receipt] = item
+            self._queues[partition].put((receipt, item))
+
+    def get(self, partition, timeout=1.0):
+        delivered = self._delivered.get(partition)
+        if delivered is not None and delivered[0] in self._pending:
+            return delivered
+        try:
+            delivery = self._queues[partition].get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self._delivered[partition] = delivery
+        return delivery
+
+    def ack(self, receipt):
+        with self._lock:
+            self._pending.pop(tuple(receipt), None)
+
+    def _drain_acks(self):
+        while True:
+            receipt = self._acks.get()
+            with self._lock:
+                self._pending.pop(tuple(receipt), None)
+
+    def reset_partition(self, partition):
+        with self._lock:
+            self._delivered.pop(partition, None)
+            self._queues[partition] = _process_context.Queue()
+            for receipt in sorted(r for r in self._pending if r[0] == partition):
+                self._queues[partition].put((receipt, self._pending[receipt]))
+
+    def worker_queue(self, partition):
+        """
+        The multiprocessing queue currently feeding a partition
+        """
+        return self._queues[partition]
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """
+    Durable WorkQueue in a SQLite database, usable by any process on the machine.
+
+    An activity handed to a worker is leased for visibility_timeout seconds; if it is not acknowledged by then, the
+    worker is assumed dead and the activity is delivered again. Activities workers gave up on are moved to the
+    dead_letters table.
+    """
+    def __init__(self, path, partitions=4, visibility_timeout=60):
+        self.path = path
+        self.partitions = partitions
+        self.visibility_timeout = visibility_timeout
+        self._local = threading.local()
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS activities (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                       'partition INTEGER NOT NULL, item TEXT NOT NULL, leased_until REAL NOT NULL DEFAULT 0)')
+            db.execute('CREATE INDEX IF NOT EXISTS activities_partition ON activities (partition, id)')
+            db.execute('CREATE TABLE IF NOT EXISTS dead_letters (id INTEGER PRIMARY KEY, partition INTEGER NOT NULL, '
+                       'item TEXT NOT NULL, error TEXT NOT NULL, failed_at REAL NOT NULL)')
+
+    def __getstate__(self):
+        return {'path': self.path, 'partitions': self.partitions, 'visibility_timeout': self.visibility_timeout}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+        return db
+
+    def put(self, key, item):
+        self._connect().execute('INSERT INTO activities (partition, item) VALUES (?, ?)',
+                                (self.partition(key), json.dumps(item)))
+
+    def get(self, partition, timeout=1.0):
+        deadline = time.monotonic() + timeout
+        db = self._connect()
+        while True:
+            now = time.time()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                row = db.execute('SELECT id, item, leased_until FROM activities WHERE partition = ? ORDER BY id LIMIT 1',
+                                 (partition,)).fetchone()
+                # The head of the partition is still leased by a live worker, later activities wait behind it
+                if row is not None and row[2] <= now:
+                    db.execute('UPDATE activities SET leased_until = ? WHERE id = ?',
+                               (now + self.visibility_timeout, row[0]))
+                    db.execute('COMMIT')
+                    return row[0], json.loads(row[1])
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.05)
+
+    def ack(self, receipt):
+        self._connect().execute('DELETE FROM activities WHERE id = ?', (receipt,))
+
+    def dead_letter(self, receipt, item, error):
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('INSERT OR REPLACE INTO dead_letters (id, partition, item, error, failed_at) '
+                       'SELECT id, partition, item, ?, ? FROM activities WHERE id = ?', (repr(error), time.time(), receipt))
+            db.execute('DELETE FROM activities WHERE id = ?', (receipt,))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def dead_letters(self, limit=100):
+        """
+        The most recent activities workers gave up on, as (activity, error, failed_at)
+        """
+        rows = self._connect().execute('SELECT item, error, failed_at FROM dead_letters ORDER BY failed_at DESC '
+                                       'LIMIT ?', (limit,)).fetchall()
+        return [(json.loads(item), error, failed_at) for item, error, failed_at in rows]
+
+    def reset_partition(self, partition):
+        # Make the activity the dead worker was handling available again right away
+        self._connect().execute('UPDATE activities SET leased_until = 0 WHERE partition = ?', (partition,))
+
+
+class InlineDispatcher():
+    """
+    Runs handlers in the calling thread, so a WorkerPool worker only acknowledges an activity once it was handled
+    """
+    workers = 1
+
+    def __init__(self):
+        self._counters = {'submitted': 0, 'completed': 0, 'failed': 0}
+
+    def submit(self, func, args=(), reply_to=None, process=False, on_reject=None, on_done=None, key=None):
+        self._counters['submitted'] += 1
+        error = None
+        started = time.perf_counter()
+        try:
+            if asyncio.iscoroutinefunction(func):
+                asyncio.run(func(*args))
+            else:
+                func(*args)
+            self._counters['completed'] += 1
+        except Exception as e:
+            error = e
+            self._counters['failed'] += 1
+            log.exception(f'Command handler {getattr(func, "__name__", func)} failed')
+        if on_done is not None:
+            try:
+                on_done(time.perf_counter() - started, error)
+            except Exception:
+                log.exception('on_done callback failed')
+        return True
+
+    def stats(self):
+        return dict(self._counters, queue_depth=0, in_flight=0)
+
+
+def is_retryable(error):
+    """
+    Whether handling an activity that failed with error may succeed later: network errors, rate limiting and server
+    errors. Anything else, e.g. a 404 for a deleted message or a bug in a handler, fails the same way every time
+    """
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, webexteamssdk.exceptions.ApiError):
+        status = error.response.status_code
+        return status in (408, 429) or status >= 500
+    return False
+
+
+def run_worker(token, setup, work_queue, partition, backend_options=None, max_attempts=5):
+    """
+    Entry point of a WorkerPool process: handle the activities of one partition with the commands setup registers
+
+    An activity failing with a retryable error is tried up to max_attempts times with backoff. One that still fails,
+    or fails with any other error, is dead lettered so it cannot hold up its partition.
+    """
+    configure_logging()
+    options = dict(backend_options or {}, register_device=False)
+    bot = FireBot(token, dispatcher=InlineDispatcher(), backend_options=options)
+    setup(bot)
+    bot.bot = CiscoWebexTeamsBackend(token, **bot._backend_options())
+    bot.router.set_mention(bot.bot.bot_identifier.displayName)
+    bot.filter.set_bot(bot.bot.bot_identifier.id)
+
+    while True:
+        delivery = work_queue.get(partition)
+        if delivery is None:
+            continue
+        receipt, activity = delivery
+        error = None
+        for attempt in range(max_attempts):
+            try:
+                bot.handle_activity(activity)
+                error = None
+                break
+            except Exception as e:
+                error = e
+                if not is_retryable(e) or attempt + 1 == max_attempts:
+                    break
+                log.warning(f'Failed to handle activity {activity.get("id")}: {e!r}, retrying')
+                time.sleep(backoff_delay(attempt, maximum=30))
+
+        if error is None:
+            work_queue.ack(receipt)
+        else:
+            log.error(f'Giving up on activity {activity.get("id")}', exc_info=error)
+            work_queue.dead_letter(receipt, activity, error)
+
+
+class WorkerPool():
+    """
+    Runs command handlers in worker processes fed by a WorkQueue, while a FireBot created with work_queue=... only
+    owns the websocket and publishes activities.
+
+    setup is called with the FireBot of each worker to register its commands. It must be a module level function so
+    it can be sent to the worker processes. Workers are spawned, so they import the main module again: start the
+    pool from under `if __name__ == "__main__":`.
+    """
+    def __init__(self, token, setup, work_queue, backend_options=None, max_attempts=5):
+        self.token = token
+        self.max_attempts = max_attempts
+        self.setup = setup
+        self.work_queue = work_queue
+        self.backend_options = backend_options
+        self._processes = {}
+        self.restarts = 0
+
+    def _spawn(self, partition):
+        work_queue = self.work_queue
+        if isinstance(work_queue, MultiprocessingWorkQueue):
+            # A worker owns exactly one partition, hand it a queue holding only that partition
+            work_queue = _PartitionView(work_queue, partition)
+        x = _process_context.Process(target=run_worker, name=f"firebot-worker-{partition}",
+                                    args=(self.token, self.setup, work_queue, partition, self.backend_options,
+                                          self.max_attempts),
+                                    daemon=True)
+        x.start()
+        self._processes[partition] = x
+
+    def start(self):
+        for partition in range(self.work_queue.partitions):
+            self._spawn(partition)
+        threading.Thread(target=self._supervise, name="firebot-worker-pool", daemon=True).start()
+
+    def _supervise(self):
+        while True:
+            time.sleep(1)
+            for partition, x in list(self._processes.items()):
+                if not x.is_alive():
+                    log.warning(f'Worker for partition {partition} exited with {x.exitcode}, restarting it')
+                    self.work_queue.reset_partition(partition)
+                    self._spawn(partition)
+                    self.restarts += 1
+
+    def stats(self):
+        return {'workers': len(self._processes),
+                'alive': sum(1 for x in self._processes.values() if x.is_alive()),
+                'restarts': self.restarts}
+
+
+class _PartitionView(WorkQueue):
+    """
+    The part of a MultiprocessingWorkQueue a single worker process needs
+    """
+    def __init__(self, work_queue, partition):
+        self._queue = work_queue.worker_queue(partition)
+        self._acks = work_queue._acks
+        self._unacked = None
+
+    def put(self, key, item):
+        raise TypeError('Activities are published to the MultiprocessingWorkQueue, not to a worker\'s partition')
+
+    def get(self, partition, timeout=1.0):
+        if self._unacked is not None:
+            return self._unacked
+        try:
+            self._unacked = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        return self._unacked
+
+    def ack(self, receipt):
+        self._unacked = None
+        self._acks.put(receipt)
+
+
+class WebhookReceiver():
+    """
+    Receives Webex Teams webhooks over HTTP as an alternative to the device websocket.
+
+    Messages and card actions are dispatched exactly like websocket activities, through the commands registered with
+    FireBot.add_command, on the asyncio runtime. Deliveries are authenticated with the HMAC-SHA1 signature Webex
+    Teams computes with the webhook secret. The receiver keeps no state beyond its caches, so several instances can
+    run behind a load balancer; only one of them needs to register the webhooks.
+    """
+    # (resource, event, filter) of the webhooks registered by default. Messages are only delivered from direct rooms
+    # and, in group rooms, when they mention the bot, the only ones FireBot handles with require_mention
+    WEBHOOKS = (('messages', 'created', 'roomType=direct'),
+                ('messages', 'created', 'roomType=group&mentionedPeople=me'),
+                ('attachmentActions', 'created', None),
+                ('memberships', 'all', None),
+                ('rooms', 'all', None))
+
+    def __init__(self, firebot, target_url, secret, host='0.0.0.0', port=8080, path='/webhook',
+                 name='pywebexbot', webhooks=WEBHOOKS, register=True):
+        """
+        :param firebot: The FireBot whose commands handle the deliveries
+        :param target_url: Public URL Webex Teams posts to, reaching path on this server
+        :param secret: Webhook secret used to sign deliveries
+        :param webhooks: (resource, event, filter) of the webhooks to register, filter may be None
+        :param register: Create or update the webhooks at start, turn off for replicas behind a load balancer
+        """
+        self.firebot = firebot
+        self.target_url = target_url
+        self.secret = secret.encode('utf-8')
+        self.host = host
+        self.port = port
+        self.path = path
+        self.name = name
+        self.webhooks = webhooks
+        self.register = register
+        self._counters = {'received': 0, 'rejected': 0, 'malformed': 0, 'duplicates': 0}
+
+    def verify(self, body, signature):
+        """
+        Check the X-Spark-Signature header of a delivery against its body
+        """
+        expected = hmac.new(self.secret, body, hashlib.sha1).hexdigest()
+        return signature is not None and hmac.compare_digest(expected, signature)
+
+    def register_webhooks(self):
+        """
+        Make sure exactly the configured webhooks exist for target_url, reusing those already registered
+        """
+        api = self.firebot.bot.webex_teams_api
+        wanted = {(resource, event, flt) for resource, event, flt in self.webhooks}
+        for webhook in api.webhooks.list():
+            if webhook.name != self.name:
+                continue
+            key = (webhook.resource, webhook.event, webhook.filter)
+            if key in wanted and webhook.targetUrl == self.target_url and webhook.status == 'active':
+                wanted.discard(key)
+            else:
+                api.webhooks.delete(webhook.id)
+        for resource, event, flt in wanted:
+            log.info(f'Registering webhook for {resource} {event}')
+            api.webhooks.create(name=self.name, targetUrl=self.target_url, resource=resource, event=event,
+                                filter=flt, secret=self.secret.decode('utf-8'))
+
+    def run(self):
+        configure_logging(**self.firebot.logging_options)
+        self.firebot._started_at = time.monotonic()
+        asyncio.run(self.run_async())
+
+    async def run_async(self, session=None):
+        from aiohttp import web
+
+        loop = asyncio.get_running_loop()
+        await self.firebot._setup_with_retry(session, register_device=False)
+        if self.register:
+            await loop.run_in_executor(None, self.register_webhooks)
+
+        app = web.Application()
+        app.router.add_post(self.path, self._handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, self.host, self.port)
+        await site.start()
+        log.info(f'Listening for webhooks on {self.host}:{self.port}{self.path}')
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+            await self.firebot.api.close()
+
+    async def _handle(self, request):
+        from aiohttp import web
+
+        body = await request.read()
+        if not self.verify(body, request.headers.get('X-Spark-Signature')):
+            self._counters['rejected'] += 1
+            return web.Response(status=403)
+        self._counters['received'] += 1
+
+        try:
+            payload = json.loads(body)
+            resource, event, data = payload['resource'], payload['event'], payload['data']
+            activity = self.activity_from_webhook(payload)
+        except (ValueError, KeyError, TypeError):
+            # Signed by Webex Teams but not a delivery we understand, retrying it would not help
+            self._counters['malformed'] += 1
+            return web.Response(status=400)
+        if activity is None:
+            self.firebot.bot.handle_room_webhook(resource, event, data)
+        elif self.firebot.dedup.seen(activity['id']):
+            self._counters['duplicates'] += 1
+        else:
+            await self.firebot.submit_activity(activity)
+        return web.Response(status=200)
+
+    def activity_from_webhook(self, payload):
+        """
+        Turn a messages or attachmentActions delivery into the activity FireBot dispatches, None for other resources
+        """
+        data = payload['data']
+        if payload['resource'] == 'messages' and payload['event'] == 'created':
+            if data.get('personId') == self.firebot.bot.bot_identifier.id:
+                return None
+            return {'id': data['id'], 'verb': 'post', 'target': {'id': data['roomId']}, 'webhook': payload}
+        if payload['resource'] == 'attachmentActions' and payload['event'] == 'created':
+            return {'id': data['id'], 'verb': 'cardAction', 'parent': {'id': data['messageId']},
+                    'target': {'id': data['roomId']}, 'webhook': payload}
+        return None
+
+    def stats(self):
+        return dict(self._counters)
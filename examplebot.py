@@ -5,7 +5,6 @@ EXAMPLE BOT
 import os
 import requests
 import sys
-import json
 import threading
 import logging
 import WebexTeamsBotHelper
@@ -35,12 +34,11 @@ class myBot():
         self.bot.send_message(msg.roomId, "HELLO")
 
     def card_command(self, msg):
-        attach = ""
         ## Create JSON here : https://developer.webex.com/buttons-and-cards-designer
-        with open('path_to_file/json.json') as f:
-            attach = json.load(f)
-
-        self.bot.send_message_with_attachment(msg.roomId, msgtxt="Card Example", attachment = attach)
+        ## The card is read and validated on first use, ${user} placeholders are filled in when sending
+        if "example" not in self.bot.cards:
+            self.bot.add_card("example", 'path_to_file/json.json')
+        self.bot.send_card(msg.roomId, "example", msgtxt="Card Example", values={'user': msg.personEmail})
 
 
     def handle_cards(self, msg, pmsg, activity):
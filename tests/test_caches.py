@@ -0,0 +1,95 @@
+import pytest
+
+import WebexTeamsBotHelper
+from WebexTeamsBotHelper import DedupWindow, TTLCache
+
+
+class Clock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(WebexTeamsBotHelper.time, 'monotonic', clock)
+    return clock
+
+
+def test_ttl_expiry(clock):
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.put('a', 1)
+    cache.put('b', 2, ttl=5)
+
+    clock.now += 4
+    assert cache.get('a') == 1
+    assert cache.get('b') == 2
+
+    clock.now += 2
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+
+    clock.now += 60
+    assert cache.get('a', 'gone') == 'gone'
+    assert len(cache) == 0
+    assert cache.stats()['misses'] == 2
+
+
+def test_ttl_cache_evicts_least_recently_used(clock):
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+
+def test_ttl_cache_invalidate_and_clear(clock):
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.put('a', 1)
+    cache.put('b', 2)
+
+    cache.invalidate('a')
+    assert cache.get('a') is None
+    cache.clear()
+    assert cache.get('b') is None
+
+
+def test_dedup_drops_repeats_within_the_window(clock):
+    dedup = DedupWindow(window=60, buckets=6)
+
+    assert dedup.seen('a') is False
+    clock.now += 30
+    assert dedup.seen('a') is True
+    assert dedup.seen('b') is False
+    assert dedup.stats() == {'tracked': 2, 'suppressed': 1}
+
+
+def test_dedup_forgets_ids_after_the_window(clock):
+    dedup = DedupWindow(window=60, buckets=6)
+    dedup.seen('a')
+
+    clock.now += 61
+    assert dedup.seen('a') is False
+
+
+def test_dedup_evicts_oldest_buckets_beyond_max_entries(clock):
+    dedup = DedupWindow(window=60, buckets=6, max_entries=3)
+    dedup.seen('old-1')
+    dedup.seen('old-2')
+    clock.now += 10
+    dedup.seen('new-1')
+    dedup.seen('new-2')
+    clock.now += 10
+    # Over max_entries now, the oldest bucket is dropped before the next id is checked
+    dedup.seen('newest')
+
+    assert dedup.seen('new-1') is True
+    assert dedup.seen('old-1') is False
@@ -0,0 +1,113 @@
+import random
+import threading
+import time
+
+from WebexTeamsBotHelper import DISPATCH_BLOCK, DISPATCH_DROP, DISPATCH_REJECT, CommandDispatcher
+
+
+def test_jobs_with_the_same_key_run_in_order():
+    dispatcher = CommandDispatcher(workers=4, max_queue=400)
+    ran = {key: [] for key in ('a', 'b', 'c')}
+    done = threading.Semaphore(0)
+
+    def job(key, i):
+        time.sleep(random.random() / 1000)
+        ran[key].append(i)
+        done.release()
+
+    for i in range(90):
+        key = 'abc'[i % 3]
+        assert dispatcher.submit(job, (key, i), key=key)
+    for _ in range(90):
+        assert done.acquire(timeout=5)
+
+    for key, order in ran.items():
+        assert order == sorted(order)
+        assert len(order) == 30
+    dispatcher.shutdown()
+
+
+def test_keys_run_concurrently():
+    dispatcher = CommandDispatcher(workers=2, max_queue=4)
+    started = threading.Barrier(3, timeout=5)
+
+    # Both jobs can only pass the barrier if they run at the same time on different workers
+    keys = ['room-0']
+    keys.append(next(f'room-{i}' for i in range(1, 100) if hash(f'room-{i}') % 2 != hash('room-0') % 2))
+    for key in keys:
+        dispatcher.submit(started.wait, key=key)
+    started.wait()
+    dispatcher.shutdown()
+
+
+def blocked_dispatcher(policy, **kwargs):
+    """
+    A dispatcher with one worker busy until release is set and its one queue slot taken
+    """
+    dispatcher = CommandDispatcher(workers=1, max_queue=1, policy=policy, **kwargs)
+    release = threading.Event()
+    running = threading.Event()
+
+    def busy():
+        running.set()
+        release.wait(5)
+
+    assert dispatcher.submit(busy)
+    assert running.wait(5)
+    assert dispatcher.submit(release.wait, (5,))
+    return dispatcher, release
+
+
+def test_drop_policy():
+    dispatcher, release = blocked_dispatcher(DISPATCH_DROP)
+
+    assert dispatcher.submit(print) is False
+    assert dispatcher.stats()['dropped'] == 1
+    release.set()
+    dispatcher.shutdown()
+
+
+def test_reject_policy_replies():
+    rejected = []
+    dispatcher, release = blocked_dispatcher(DISPATCH_REJECT, on_reject=rejected.append)
+
+    assert dispatcher.submit(print, reply_to='room') is False
+    assert dispatcher.submit(print, reply_to='other', on_reject=lambda room: rejected.append(room.upper())) is False
+    assert rejected == ['room', 'OTHER']
+    assert dispatcher.stats()['rejected'] == 2
+    release.set()
+    dispatcher.shutdown()
+
+
+def test_block_policy_waits_then_gives_up():
+    dispatcher, release = blocked_dispatcher(DISPATCH_BLOCK, block_timeout=0.1)
+
+    started = time.monotonic()
+    assert dispatcher.submit(print) is False
+    assert time.monotonic() - started >= 0.1
+    assert dispatcher.stats()['dropped'] == 1
+    release.set()
+    dispatcher.shutdown()
+
+
+def test_on_done_reports_errors_and_survives_failing_callbacks():
+    dispatcher = CommandDispatcher(workers=1, max_queue=4)
+    outcomes = []
+    done = threading.Event()
+
+    def fail():
+        raise ValueError('boom')
+
+    def broken_callback(seconds, error):
+        raise RuntimeError('callback')
+
+    dispatcher.submit(fail, on_done=lambda seconds, error: outcomes.append(error))
+    dispatcher.submit(print, ('after a failure',), on_done=broken_callback)
+    dispatcher.submit(done.set)
+
+    assert done.wait(5)
+    assert isinstance(outcomes[0], ValueError)
+    stats = dispatcher.stats()
+    assert stats['failed'] == 1
+    assert stats['completed'] == 2
+    dispatcher.shutdown()
@@ -0,0 +1,97 @@
+import io
+
+import pytest
+import requests
+
+from WebexTeamsBotHelper import FileTooLarge, MultipartStream
+
+
+def prepare(body):
+    return requests.Request('POST', 'https://webexapis.com/v1/messages', data=body,
+                            headers={'Content-Type': body.content_type}).prepare()
+
+
+def parse(body, content):
+    """
+    Split a multipart body into {name: (headers, value)}
+    """
+    boundary = f'--{body.boundary}'.encode()
+    assert content.endswith(boundary + b'--\r\n')
+    parts = {}
+    for part in content.split(boundary)[1:-1]:
+        headers, value = part[2:].split(b'\r\n\r\n', 1)
+        name = headers.split(b'name="')[1].split(b'"')[0].decode()
+        parts[name] = (headers.decode(), value[:-2])
+    return parts
+
+
+def test_content_length_from_a_path(tmp_path):
+    path = tmp_path / 'report.txt'
+    path.write_bytes(b'x' * 200000)
+    body = MultipartStream({'roomId': 'room', 'text': 'here', 'parentId': None}, str(path))
+
+    request = prepare(body)
+    content = b''.join(body)
+
+    assert request.headers['Content-Length'] == str(len(content))
+    assert 'Transfer-Encoding' not in request.headers
+    parts = parse(body, content)
+    assert set(parts) == {'roomId', 'text', 'files'}
+    assert parts['roomId'][1] == b'room'
+    assert 'filename="report.txt"' in parts['files'][0]
+    assert 'Content-Type: text/plain' in parts['files'][0]
+    assert parts['files'][1] == b'x' * 200000
+
+
+def test_content_length_from_a_file_object_read_from_its_position():
+    source = io.BytesIO(b'skip' + b'y' * 1000)
+    source.read(4)
+    body = MultipartStream({'roomId': 'room'}, source, filename='data.bin')
+
+    assert body.size == 1000
+    assert prepare(body).headers['Content-Length'] == str(len(b''.join(body)))
+    assert parse(body, b''.join(body))['files'][1] == b'y' * 1000
+
+
+def test_unknown_size_is_sent_chunked():
+    chunks = iter([b'a' * 10, b'b' * 20])
+    body = MultipartStream({'roomId': 'room'}, chunks, filename='stream.bin')
+
+    request = prepare(body)
+
+    assert len(body) == 0
+    assert request.headers['Transfer-Encoding'] == 'chunked'
+    assert 'Content-Length' not in request.headers
+    assert parse(body, b''.join(body))['files'][1] == b'a' * 10 + b'b' * 20
+
+
+def test_replayable_bodies(tmp_path):
+    path = tmp_path / 'f.bin'
+    path.write_bytes(b'z' * 100)
+    source = io.BytesIO(b'z' * 100)
+
+    for body in (MultipartStream({}, str(path)), MultipartStream({}, source, filename='f.bin')):
+        assert body.replayable
+        assert b''.join(body) == b''.join(body)
+
+    once = MultipartStream({}, iter([b'z' * 100]), filename='f.bin', size=100)
+    assert not once.replayable
+
+
+def test_progress_is_reported():
+    progress = []
+    body = MultipartStream({}, io.BytesIO(b'p' * 100), filename='f.bin', chunk_size=40,
+                           progress=lambda sent, total: progress.append((sent, total)))
+    b''.join(body)
+
+    assert progress == [(40, 100), (80, 100), (100, 100)]
+
+
+def test_too_large():
+    with pytest.raises(FileTooLarge):
+        MultipartStream({}, io.BytesIO(b'x' * 11), filename='f.bin', limit=10)
+
+    # Found out while sending when the size is not known up front
+    body = MultipartStream({}, iter([b'x' * 6, b'x' * 6]), filename='f.bin', limit=10)
+    with pytest.raises(FileTooLarge):
+        b''.join(body)
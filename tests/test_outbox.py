@@ -0,0 +1,133 @@
+import threading
+import time
+
+import requests
+import webexteamssdk
+
+from WebexTeamsBotHelper import Metrics, Outbox
+
+
+def rate_limit_error(retry_after):
+    response = requests.Response()
+    response.status_code = 429
+    response.request = requests.Request('POST', 'https://webexapis.com/v1/messages').prepare()
+    error = webexteamssdk.exceptions.RateLimitError(response)
+    error.retry_after = retry_after
+    return error
+
+
+class FakeMessages():
+    """
+    Records the text of each message sent, raising a 429 on the first attempt of the texts in rate_limited
+    """
+    def __init__(self, rate_limited=(), delay=0.0):
+        self.rate_limited = set(rate_limited)
+        self.delay = delay
+        self.sent = []
+        self.attempts = []
+        self.in_flight = {}
+        self.overlapped = False
+        self._lock = threading.Lock()
+
+    def create(self, roomId=None, text=None, **kwargs):
+        with self._lock:
+            self.attempts.append(text)
+            self.in_flight[roomId] = self.in_flight.get(roomId, 0) + 1
+            if self.in_flight[roomId] > 1:
+                self.overlapped = True
+        try:
+            time.sleep(self.delay)
+            with self._lock:
+                if text in self.rate_limited:
+                    self.rate_limited.discard(text)
+                    raise rate_limit_error(0.05)
+                self.sent.append((roomId, text))
+            return text
+        finally:
+            with self._lock:
+                self.in_flight[roomId] -= 1
+
+
+class FakeBackend():
+    def __init__(self, messages):
+        self.metrics = Metrics()
+        self.send_api = type('SendApi', (), {'messages': messages})()
+
+
+def make_outbox(messages, **kwargs):
+    kwargs.setdefault('rate', 1000)
+    kwargs.setdefault('burst', 1000)
+    kwargs.setdefault('room_rate', 1000)
+    kwargs.setdefault('room_burst', 1000)
+    return Outbox(FakeBackend(messages), **kwargs)
+
+
+def test_room_order_kept_across_a_rate_limit():
+    messages = FakeMessages(rate_limited={'1'})
+    outbox = make_outbox(messages, workers=4)
+
+    futures = [outbox.submit({'roomId': 'room', 'text': str(i)}) for i in range(6)]
+
+    assert [future.result(5) for future in futures] == [str(i) for i in range(6)]
+    assert [text for _, text in messages.sent] == [str(i) for i in range(6)]
+    assert messages.attempts.count('1') == 2
+    assert outbox.stats()['rate_limited'] == 1
+
+
+def test_one_send_in_flight_per_room():
+    messages = FakeMessages(delay=0.01)
+    outbox = make_outbox(messages, workers=4)
+
+    futures = [outbox.submit({'roomId': f'room{i % 2}', 'text': str(i)}) for i in range(10)]
+    for future in futures:
+        future.result(5)
+
+    assert not messages.overlapped
+    for room in ('room0', 'room1'):
+        texts = [text for roomId, text in messages.sent if roomId == room]
+        assert texts == sorted(texts, key=int)
+
+
+def test_rooms_are_sent_concurrently():
+    messages = FakeMessages(delay=0.2)
+    outbox = make_outbox(messages, workers=4)
+
+    started = time.monotonic()
+    futures = [outbox.submit({'roomId': f'room{i}', 'text': str(i)}) for i in range(4)]
+    for future in futures:
+        future.result(5)
+
+    assert time.monotonic() - started < 0.6
+
+
+def test_gives_up_after_max_retries():
+    messages = FakeMessages()
+    messages.create = lambda **kwargs: (_ for _ in ()).throw(rate_limit_error(0.01))
+    outbox = make_outbox(messages, workers=1, max_retries=2)
+
+    future = outbox.submit({'roomId': 'room', 'text': 'x'})
+
+    try:
+        future.result(5)
+    except webexteamssdk.exceptions.RateLimitError:
+        pass
+    else:
+        raise AssertionError('expected RateLimitError')
+    stats = outbox.stats()
+    assert stats['rate_limited'] == 2
+    assert stats['failed'] == 1
+    assert stats['queue_depth'] == 0
+
+
+def test_cancelled_message_is_not_sent():
+    messages = FakeMessages(delay=0.1)
+    outbox = make_outbox(messages, workers=1)
+
+    first = outbox.submit({'roomId': 'room', 'text': 'first'})
+    second = outbox.submit({'roomId': 'room', 'text': 'second'})
+    third = outbox.submit({'roomId': 'room', 'text': 'third'})
+    assert second.cancel()
+
+    assert first.result(5) == 'first'
+    assert third.result(5) == 'third'
+    assert [text for _, text in messages.sent] == ['first', 'third']
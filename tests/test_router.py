@@ -0,0 +1,83 @@
+from WebexTeamsBotHelper import CommandRoute, CommandRouter
+
+
+def handler(*args):
+    pass
+
+
+def make_router(*routes):
+    router = CommandRouter()
+    for route in routes:
+        router.add(route)
+    router.set_mention('Fire Bot')
+    return router
+
+
+def matched(router, text):
+    result = router.match(text)
+    return None if result is None else (result[0].name, result[1])
+
+
+def test_exact_and_case_insensitive():
+    router = make_router(CommandRoute('hello', handler))
+
+    assert matched(router, 'hello') == ('hello', None)
+    assert matched(router, 'HeLLo') == ('hello', None)
+    assert matched(router, '  hello  ') == ('hello', None)
+    assert matched(router, 'goodbye') is None
+    assert matched(router, '') is None
+
+
+def test_spaces_are_ignored_like_before():
+    router = make_router(CommandRoute('hello', handler), CommandRoute('cardcommand', handler),
+                         CommandRoute('card action', handler))
+
+    assert matched(router, 'hel p') is None
+    assert matched(router, 'hel lo') == ('hello', None)
+    assert matched(router, 'h e l l o') == ('hello', None)
+    assert matched(router, 'card command') == ('cardcommand', None)
+    assert matched(router, 'cardc ommand') == ('cardcommand', None)
+    assert matched(router, 'cardaction') == ('card action', None)
+    assert matched(router, 'card action') == ('card action', None)
+
+
+def test_leading_mention_is_stripped():
+    router = make_router(CommandRoute('hello', handler))
+
+    assert matched(router, 'Fire Bot hello') == ('hello', None)
+    assert matched(router, 'Fire hello') == ('hello', None)
+    assert matched(router, 'fire bot, hello') == ('hello', None)
+    assert matched(router, 'Firehello') is None
+
+
+def test_longest_command_wins():
+    router = make_router(CommandRoute('card', handler), CommandRoute('cardcommand', handler))
+
+    assert matched(router, 'card') == ('card', None)
+    assert matched(router, 'cardcommand') == ('cardcommand', None)
+
+
+def test_aliases():
+    router = make_router(CommandRoute('hello', handler, aliases=('hi',)))
+
+    assert matched(router, 'hi') == ('hello', None)
+
+
+def test_arguments():
+    router = make_router(CommandRoute('echo', handler, args=True),
+                         CommandRoute('deploy', handler, args=r'(?P<service>\w+) to (?P<env>\w+)'),
+                         CommandRoute('hello', handler))
+
+    assert matched(router, 'echo one two') == ('echo', ['one', 'two'])
+    assert matched(router, 'echo') == ('echo', [])
+    assert matched(router, 'Fire Bot deploy api to prod') == ('deploy', {'service': 'api', 'env': 'prod'})
+    assert matched(router, 'deploy api') is None
+    # A command without an argument pattern takes no arguments
+    assert matched(router, 'hello there') is None
+
+
+def test_remove():
+    router = make_router(CommandRoute('hello', handler))
+    router.remove('hello')
+
+    assert matched(router, 'hello') is None